@@ -1,6 +1,9 @@
 """This module contains auxiliary functions for importing data which are used in the main notebook."""
 
 #Packages
+import hashlib
+import json
+import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -23,6 +26,112 @@ pd.options.display.float_format = "{:,.2f}".format
 from auxiliary.plots import *
 from auxiliary.simulations import *
 from auxiliary.tables import *
+from auxiliary.spatial_weights import contiguity_pairs, contiguity_weights, expand_weights
+
+# location of the columnar copies of the stata files
+CACHE_PATH = "data/cache"
+
+def _file_hash(path):
+    """
+    Returns: sha256 of a file (hex string)
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _write_json(meta, path):
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+def _refresh_cache(name, cache_dir):
+    """
+    Makes sure that the parquet copy of data/<name>.dta is up to date
+        The copy is valid if size and modification time of the source are
+        unchanged or, if only the time changed, the hash is the same.
+        The variable labels are kept in the metadata of the copy.
+
+    Returns: data (dataframe if the stata file was parsed, else None), meta (dictionary)
+    """
+    source = f"data/{name}.dta"
+    cache = os.path.join(cache_dir, f"{name}.parquet")
+    meta_path = os.path.join(cache_dir, f"{name}.json")
+
+    stat = os.stat(source)
+    meta = {"mtime": stat.st_mtime, "size": stat.st_size}
+
+    if os.path.exists(cache) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            cached = json.load(f)
+        if cached["size"] == meta["size"] and "labels" in cached:
+            if cached["mtime"] == meta["mtime"]:
+                return None, cached
+            #touched, but maybe not modified
+            meta["sha256"] = _file_hash(source)
+            if cached["sha256"] == meta["sha256"]:
+                meta["labels"] = cached["labels"]
+                _write_json(meta, meta_path)
+                return None, meta
+
+    # parse the data and the labels in one go
+    with pd.read_stata(source, iterator=True) as reader:
+        data = reader.read()
+        meta["labels"] = reader.variable_labels()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    data.to_parquet(cache + ".tmp")
+    os.replace(cache + ".tmp", cache)
+    meta["sha256"] = meta.get("sha256") or _file_hash(source)
+    _write_json(meta, meta_path)
+
+    return data, meta
+
+# Cached data access
+def read_dataset(name, columns=None, cache_dir=CACHE_PATH):
+    """
+    Loads one of the stata data sets (regiondata, citydata, countrydata, ...)
+        The .dta file is only parsed once and converted to a parquet copy in
+        cache_dir. Later loads read the copy, which is checked against the size
+        and modification time of the source and, if the time changed, its hash.
+
+    Inputs:
+        - name: name of the data set, i.e. data/<name>.dta
+        - columns: list of columns to load (default: all)
+        - cache_dir: directory of the parquet copies
+
+    Returns: a dataframe
+    """
+    data, _ = _refresh_cache(name, cache_dir)
+    if data is not None and columns is None:
+        return data
+
+    return pd.read_parquet(os.path.join(cache_dir, f"{name}.parquet"), columns=columns)
+
+# in-memory index of the variable labels: name -> ((mtime, size), labels)
+_label_index = {}
+
+def get_variable_labels(name, cache_dir=CACHE_PATH):
+    """
+    Returns the stata variable labels of a data set
+        The labels are kept in memory and in the metadata of the parquet copy,
+        so the stata file is not opened again unless it changes (which is
+        detected from its size and modification time).
+
+    Inputs:
+        - name: name of the data set, i.e. data/<name>.dta
+
+    Returns: labels (dictionary, column name -> label)
+    """
+    stat = os.stat(f"data/{name}.dta")
+    signature = (stat.st_mtime, stat.st_size)
+
+    if name not in _label_index or _label_index[name][0] != signature:
+        _, meta = _refresh_cache(name, cache_dir)
+        _label_index[name] = (signature, meta["labels"])
+
+    return _label_index[name][1]
 
 # Importing data
 def importing_regiondata():
@@ -33,9 +142,21 @@ def importing_regiondata():
         Should immediately create geopandas dataframe
     Returns: a dataframe
     """
-    regiondata = pd.read_stata("data/regiondata.dta")
+    regiondata = read_dataset("regiondata")
     return regiondata
 
+# point geometries
+def points_from_lonlat(data):
+    """
+    Converts a dataframe with lon and lat columns into a GeoPandas DF
+        The points are created in one vectorized call instead of one
+        geom.Point per row.
+
+    Returns: a GeoPandas dataframe (EPSG:4326)
+    """
+    points = gpd.points_from_xy(data["lon"], data["lat"])
+    return gpd.GeoDataFrame(data, geometry=points, crs="EPSG:4326")
+
 # Get spatial data
 def get_spatialdata():
     """
@@ -44,50 +165,165 @@ def get_spatialdata():
     Returns: two GeoPandas dataframes (regiondata, citydata)
     """
     #district level
-    ##creating pandas dataframe
-    regiondata = pd.read_stata("data/regiondata.dta") #--> need to also do for other 
+    regiondata = points_from_lonlat(read_dataset("regiondata"))
     #regiondata = regiondata.query("abspctileADsm0_2moistu > 6 & abspctileADurbfrac > 6")
 
-    ##creating geopandas dataframe
-    regiondata["geometry"] = regiondata[["lon", "lat"]].apply(geom.Point, axis=1) #take each row
-    regiondata = gpd.GeoDataFrame(regiondata)
-    regiondata.crs = "EPSG:4326"
-    
     #city level
-    ##creating pandas dataframe
-    citydata = pd.read_stata("data/citydata.dta")
-    #regiondata = regiondata.query("abspctileADsm0_2moistu > 6 & abspctileADurbfrac > 6")
+    citydata = points_from_lonlat(read_dataset("citydata"))
 
-    ##creating geopandas dataframe
-    citydata["geometry"] = citydata[["lon", "lat"]].apply(geom.Point, axis=1) #take each row
-    citydata = gpd.GeoDataFrame(citydata)
-    citydata.crs = "EPSG:4326"
-    
     return regiondata, citydata
 
+def _path_signature(path):
+    """
+    Returns: list with name, size and modification time of a file or of all files in a directory
+    """
+    if os.path.isdir(path):
+        names = sorted(os.listdir(path))
+        return [[name, os.stat(os.path.join(path, name)).st_size, os.stat(os.path.join(path, name)).st_mtime]
+                for name in names]
+    stat = os.stat(path)
+    return [[os.path.basename(path), stat.st_size, stat.st_mtime]]
 
-# Get shape file
-def get_shapefile():
-    #creating relevant shapefile
-    #--------------------
-    regiondata = pd.read_stata("data/regiondata.dta") 
+# Join districts and regiondata
+def get_district_join(cache_dir=CACHE_PATH):
+    """
+    Joins the regiondata points with the district polygons of afrregnew.gdb
+        The join is computed once, with the spatial index of the districts
+        built before the join, and saved as GeoParquet in cache_dir. It is
+        reloaded as long as regiondata.dta and the geodatabase are unchanged.
+
+    Returns: gdb_join (GeoPandas dataframe with one row per regiondata observation
+        and district, i.e. a district appears once per period and once without
+        observations; the index is the row of the district in the geodatabase
+        and index_left the index of the observation in regiondata)
+    """
+    sources = ["data/regiondata.dta", "data/Henderson_shapefile/afrregnew.gdb"]
+    signature = [_path_signature(path) for path in sources]
+    cache = os.path.join(cache_dir, "district_join.parquet")
+    meta_path = os.path.join(cache_dir, "district_join.json")
+
+    if os.path.exists(cache) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)["signature"] == signature:
+                return gpd.read_parquet(cache)
 
-    ###creating geopandas dataframe
-    regiondata["geometry"] = regiondata[["lon", "lat"]].apply(geom.Point, axis=1) #take each row
-    regiondata = gpd.GeoDataFrame(regiondata)
-    regiondata.crs = "EPSG:4326"
+    regiondata = points_from_lonlat(read_dataset("regiondata"))
 
     ### districts shapefile
     areg = gpd.read_file("data/Henderson_shapefile/afrregnew.gdb")
     areg.crs = "EPSG:4326"
+    areg.sindex #build the spatial index (R-tree) once, used by the join
+
+    ### Joining region data and districts
+    gdb_join = gpd.sjoin(regiondata, areg, how="right", op="within")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    gdb_join.to_parquet(cache + ".tmp")
+    os.replace(cache + ".tmp", cache)
+    _write_json({"signature": signature}, meta_path)
+
+    return gdb_join
+
+# Contiguity weights of the districts
+def get_district_weights(kind="queen", transform="R", tolerance=0.0, cache_dir=CACHE_PATH):
+    """
+    Contiguity weights of the district polygons of afrregnew.gdb
+        The touching pairs and the length of their common border are computed once
+        (see contiguity_pairs, candidates from an STR-tree) in the Africa
+        Equidistant Conic projection and saved in cache_dir. They are reloaded as
+        long as the geodatabase and the tolerance are unchanged, so all kinds of
+        weights are built from the saved pairs.
+
+    Inputs:
+        - kind: "queen", "rook" or "border" (weighted by the common border in km)
+        - transform: libpysal transformation
+        - tolerance: distance in km below which districts count as touching
+
+    Returns: w (libpysal weights object, ids from the row order of the geodatabase,
+        which is the index of get_district_join, one entry per district; see
+        get_regiondata_weights for the weights between the rows of regiondata)
+    """
+    source = "data/Henderson_shapefile/afrregnew.gdb"
+    signature = {"source": _path_signature(source), "tolerance": tolerance}
+    cache = os.path.join(cache_dir, "district_contiguity.npz")
+    meta_path = os.path.join(cache_dir, "district_contiguity.json")
+
+    pairs = None
+    if os.path.exists(cache) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)["signature"] == signature:
+                with np.load(cache) as saved:
+                    pairs = {name: saved[name] for name in saved.files}
+
+    if pairs is None:
+        areg = gpd.read_file(source)
+        areg.crs = "EPSG:4326"
+        districts = areg.to_crs("ESRI:102023").geometry #in metres
+        rows, cols, length = contiguity_pairs(districts, tolerance=tolerance*1000)
+        pairs = {"rows": rows, "cols": cols, "length": length/1000, "index": areg.index.to_numpy()}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache + ".tmp", "wb") as f: #np.savez would append .npz to the name
+            np.savez(f, **pairs)
+        os.replace(cache + ".tmp", cache)
+        _write_json({"signature": signature}, meta_path)
+
+    return contiguity_weights(pairs["rows"], pairs["cols"], pairs["length"], len(pairs["index"]),
+                              kind=kind, ids=pairs["index"].tolist(), transform=transform)
+
+def get_regiondata_districts(regiondata, cache_dir=CACHE_PATH):
+    """
+    District (row of the geodatabase) of every observation of regiondata
+        Taken from get_district_join, an observation within several polygons
+        gets the first one.
+
+    Returns: districts (Series with the index of regiondata, NaN outside all districts)
+    """
+    gdb_join = get_district_join(cache_dir=cache_dir)
+    matched = gdb_join.dropna(subset=["index_left"])
+    districts = pd.Series(matched.index, index=matched["index_left"].astype(regiondata.index.dtype))
+    districts = districts[~districts.index.duplicated()]
+
+    return districts.reindex(regiondata.index)
+
+def get_regiondata_weights(regiondata, kind="queen", transform="R", tolerance=0.0, within=False,
+                           cache_dir=CACHE_PATH):
+    """
+    District contiguity weights between the rows of regiondata
+        regiondata has one row per district and period, so the weights of
+        get_district_weights are expanded to the rows (see expand_weights):
+        two rows are neighbors if their districts are. Also works for a
+        filtered regiondata (e.g. without outliers), the ids are its index.
+
+    Inputs:
+        - regiondata: data frame (regiondata or a subset of its rows)
+        - kind, tolerance: see get_district_weights
+        - transform: libpysal transformation
+        - within: whether the rows of the same district (other periods) are neighbors
+
+    Returns: w (libpysal weights object, ids from the index of regiondata)
+    """
+    w = get_district_weights(kind=kind, transform="O", tolerance=tolerance, cache_dir=cache_dir)
+    districts = get_regiondata_districts(regiondata, cache_dir=cache_dir)
+
+    return expand_weights(w, districts, transform=transform, within=within)
+
+# Get shape file
+def get_shapefile():
+    """
+    Loads the districts (joined with regiondata, see get_district_join)
+    and the coastline
+
+    Returns: two GeoPandas dataframes (gdb_join, coast)
+    """
+    #creating relevant shapefile
+    #--------------------
+    gdb_join = get_district_join()
 
     ### coastlien shapefile
     coast = gpd.read_file("data/afr_g2014_2013_0.shp")
     coast.crs = "EPSG:4326"
 
-    ### Joining region data and districts
-    gdb_join = gpd.sjoin(regiondata, areg, how="right", op="within")
-
     return gdb_join, coast
 
 # Creating table 1 a (regiondata)
@@ -0,0 +1,790 @@
+"""This module contains auxiliary estimators working directly on arrays, which are used in the simulations and the regression tables."""
+
+#Packages
+from collections import namedtuple
+
+import pandas as pd
+import numpy as np
+from scipy import interpolate, linalg, optimize, sparse, spatial, stats
+from scipy.sparse import linalg as splinalg
+
+from auxiliary.parallel import seed_sequence, spawn_batches, thread_map
+from auxiliary.result_cache import (LRUCache, cached_result, fingerprint_frame, fingerprint_source,
+                                    fingerprint_weights)
+
+
+# fingerprint of this module, cached results are only reused for the same estimators
+ESTIMATION_FINGERPRINT = fingerprint_source(__file__)
+
+# radius of the earth in km, for the distances of the Conley covariance
+EARTH_RADIUS = 6371.0
+
+# largest sample for which the log-determinant uses the eigenvalues of W
+EIGEN_MAX_OBS = 1000
+# maximum number of log-determinants and trace series kept in the cache
+LOGDET_CACHE_SIZE = 8
+
+_logdet_cache = LRUCache(LOGDET_CACHE_SIZE)
+
+
+def _design(X, add_constant):
+    """
+    Adds a column of ones in front of the regressors (like the intercept of a formula)
+    """
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1: #single regressor
+        X = X[..., np.newaxis]
+    if add_constant:
+        ones = np.ones(X.shape[:-1] + (1,))
+        X = np.concatenate([ones, X], axis=-1)
+    return X
+
+# OLS without formulas
+def fast_ols(y, X, add_constant=True, se=False):
+    """
+    Estimates OLS coefficients from arrays through a QR factorization
+        y may hold several outcomes (one per column), which are all estimated
+        with one factorization of the shared regressors. If the regressors
+        differ between replications, X can be stacked as (R, N, k) and y as (N, R).
+        Coefficients are ordered as the regressors, with the constant first, i.e.
+        fast_ols(Y, np.column_stack([X, D]))[2] equals the D coefficient of
+        smf.ols("Y ~ X + D").
+
+    Inputs:
+        - y: array of shape (N,) or (N, R)
+        - X: array of shape (N, k), or (R, N, k) with one design per column of y
+        - add_constant: whether to add an intercept
+        - se: whether to also return the (non-robust) standard errors
+
+    Returns: params (array of shape (k,) or (k, R)), and bse (same shape) if se=True
+    """
+    y = np.asarray(y, dtype=float)
+    X = _design(X, add_constant)
+
+    if X.ndim == 3: #one design per replication
+        results = [fast_ols(y[:, r], X[r], add_constant=False, se=se) for r in range(X.shape[0])]
+        if se:
+            return (np.column_stack([result[0] for result in results]),
+                    np.column_stack([result[1] for result in results]))
+        return np.column_stack(results)
+
+    Q, R = np.linalg.qr(X) #reduced QR, X = QR
+    params = linalg.solve_triangular(R, Q.T.dot(y))
+
+    if not se:
+        return params
+
+    # non-robust covariance sigma^2 (X'X)^-1 = sigma^2 R^-1 R^-T
+    n, k = X.shape
+    resid = y - X.dot(params)
+    sigma2 = np.sum(resid**2, axis=0)/(n - k)
+    R_inv = linalg.solve_triangular(R, np.eye(k))
+    diag = np.sum(R_inv**2, axis=1)
+    bse = np.sqrt(np.multiply.outer(diag, sigma2))
+
+    return params, bse
+
+def _orthonormal_basis(H, rtol=1e-10):
+    """
+    Orthonormal basis of the column space of H from a pivoted QR
+        Redundant (collinear) instruments are dropped instead of making the
+        projection singular.
+    """
+    Q, R, _ = linalg.qr(H, mode="economic", pivoting=True)
+    diag = np.abs(np.diag(R))
+    rank = int(np.sum(diag > rtol*diag[0])) if diag.size else 0
+    return Q[:, :rank]
+
+# spatial two stage least squares
+def spatial_2sls(y, X, w, w_lags=1, se=False):
+    """
+    Estimates the spatial lag model y = rho*Wy + X*beta + e by two stage least squares
+        Equivalent to spreg.GM_Lag(y, X, w=w, w_lags=w_lags): Wy is instrumented with
+        the constant, X and its spatial lags WX, ..., W^w_lags X. Several outcomes
+        (columns of y) are estimated together: the spatial lags are computed with
+        one sparse product for all columns and, if X is shared, the instrument
+        projection is factorized only once.
+
+    Inputs:
+        - y: array of shape (N,) or (N, R)
+        - X: array of shape (N, k), or (R, N, k) with one design per column of y
+        - w: libpysal weights object (used with its current transform, e.g. "r")
+        - w_lags: order of the spatial lags of X used as instruments
+        - se: whether to also return the standard errors
+
+    Returns: betas (array of shape (k+2,) or (k+2, R), ordered constant, X, W_Y),
+        and std_err (same shape) if se=True
+    """
+    y = np.asarray(y, dtype=float)
+    single = y.ndim == 1
+    if single:
+        y = y[:, np.newaxis]
+    N, n_reps = y.shape
+
+    W = w.sparse.tocsr()
+    X = _design(X, add_constant=False)
+    shared = X.ndim == 2
+    Xs = X[np.newaxis] if shared else X #(S, N, k) with S = 1 or R
+    S, _, k = Xs.shape
+
+    # instruments: spatial lags of all designs with one sparse product per order
+    X1 = np.concatenate([np.ones((S, N, 1)), Xs], axis=-1)
+    block = Xs.transpose(1, 0, 2).reshape(N, S*k)
+    H = [X1]
+    for _ in range(w_lags):
+        block = W.dot(block)
+        H.append(block.reshape(N, S, k).transpose(1, 0, 2))
+    H = np.concatenate(H, axis=-1)
+
+    # first stage: project the endogenous Wy on the instruments
+    Wy = W.dot(y)
+    if shared:
+        Q = _orthonormal_basis(H[0])
+        Wy_hat = Q.dot(Q.T.dot(Wy))
+    else:
+        Wy_hat = np.empty_like(Wy)
+        for r in range(n_reps):
+            Q = _orthonormal_basis(H[r])
+            Wy_hat[:, r] = Q.dot(Q.T.dot(Wy[:, r]))
+
+    # second stage: (Z_hat'Z)^-1 Z_hat'y for all outcomes at once
+    X1 = np.broadcast_to(X1, (n_reps, N, k + 1))
+    Z = np.concatenate([X1, Wy.T[..., np.newaxis]], axis=-1)
+    Z_hat = np.concatenate([X1, Wy_hat.T[..., np.newaxis]], axis=-1)
+    A = np.einsum("rnk,rnl->rkl", Z_hat, Z)
+    b = np.einsum("rnk,rn->rk", Z_hat, y.T)
+    betas = np.linalg.solve(A, b[..., np.newaxis])[..., 0]
+
+    if se:
+        resid = y.T - np.einsum("rnk,rk->rn", Z, betas)
+        sig2 = np.sum(resid**2, axis=1)/N #as in spreg (no small sample correction)
+        varb = np.linalg.inv(np.einsum("rnk,rnl->rkl", Z_hat, Z_hat))
+        std_err = np.sqrt(np.diagonal(varb, axis1=1, axis2=2)*sig2[:, np.newaxis])
+        if single:
+            return betas[0], std_err[0]
+        return betas.T, std_err.T
+
+    return betas[0] if single else betas.T
+
+
+# log-determinant of the spatial lag model
+def _logdet_method(W, method):
+    if method == "auto":
+        return "eigen" if W.shape[0] <= EIGEN_MAX_OBS else "mc"
+    if method not in ("eigen", "lu", "mc"):
+        raise ValueError(f"Unknown method {method}")
+    return method
+
+def log_determinant(w, method="auto", order=50, probes=30, seed=0):
+    """
+    Returns a function evaluating log|I - rho*W| for any rho (scalar or array)
+        The expensive part is computed once per weights object and cached by the
+        fingerprint of W, so that every evaluation during the optimization over
+        rho costs O(N) (eigen) or O(order) (lu, mc):
+        - "eigen": eigenvalues of the dense W, sum of log|1 - rho*lambda| (exact)
+        - "lu": sparse LU of I - rho*W on a grid of rho in (-1, 1), interpolated
+          by a cubic spline
+        - "mc": Monte Carlo estimate of the traces tr(W^j) (Barry and Pace, 1999)
+          with a truncated series -sum_j rho^j tr(W^j)/j, tr(W) and tr(W^2) exact
+        "auto" uses the eigenvalues up to EIGEN_MAX_OBS observations and "mc" above.
+
+    Inputs:
+        - w: libpysal weights object (used with its current transform, e.g. "r")
+        - method: "auto", "eigen", "lu" or "mc"
+        - order: number of terms of the series (mc)
+        - probes: number of random vectors of the trace estimate (mc)
+        - seed: seed of the random vectors (mc)
+
+    Returns: logdet (function of rho)
+    """
+    W = w.sparse.tocsr()
+    nobs = W.shape[0]
+    method = _logdet_method(W, method)
+    key = (fingerprint_weights(w), method, order, probes, seed)
+
+    if key in _logdet_cache:
+        return _logdet_cache.lookup(key)
+
+    if method == "eigen":
+        eigenvalues = linalg.eigvals(W.toarray())
+
+        def logdet(rho):
+            rho = np.asarray(rho, dtype=float)
+            return np.sum(np.log(np.abs(1 - np.multiply.outer(rho, eigenvalues))), axis=-1)
+    elif method == "lu":
+        grid = np.linspace(-0.999, 0.999, 101)
+        identity = sparse.identity(nobs, format="csc")
+        values = []
+        for rho in grid:
+            diag = splinalg.splu((identity - rho*W).tocsc()).U.diagonal()
+            values.append(np.sum(np.log(np.abs(diag))))
+        logdet = interpolate.CubicSpline(grid, values)
+    else:
+        traces = power_traces(w, order=order, probes=probes, seed=seed)
+        powers = np.arange(1, order + 1)
+
+        def logdet(rho):
+            rho = np.asarray(rho, dtype=float)
+            return -np.sum(np.power.outer(rho, powers)*traces/powers, axis=-1)
+
+    return _logdet_cache.store(key, logdet)
+
+def power_traces(w, order=50, probes=30, seed=0):
+    """
+    Monte Carlo estimates of the traces tr(W^j), j = 1, ..., order
+        E[x'W^j x/x'x]*N for random normal x, from one sparse product per power
+        for all probes (Barry and Pace, 1999). tr(W) and tr(W^2) are exact.
+        Cached per weights object as log_determinant.
+
+    Returns: traces (array (order,))
+    """
+    key = (fingerprint_weights(w), "traces", order, probes, seed)
+    if key in _logdet_cache:
+        return _logdet_cache.lookup(key)
+
+    W = w.sparse.tocsr()
+    nobs = W.shape[0]
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((nobs, probes))
+    traces = np.empty(order)
+    block = x
+    for j in range(order):
+        block = W.dot(block)
+        traces[j] = nobs*np.mean(np.sum(x*block, axis=0)/np.sum(x**2, axis=0))
+    traces[0] = W.diagonal().sum()
+    if order > 1:
+        traces[1] = W.multiply(W.T).sum()
+
+    return _logdet_cache.store(key, traces)
+
+def _lag_traces(W, rho, method, probes=30, seed=0):
+    """
+    Traces tr(B), tr(BB) and tr(B'B) of B = W(I - rho*W)^-1 for the information matrix
+        Exact from the dense inverse for small samples ("eigen"), otherwise
+        estimated with random +-1 vectors and one sparse LU of I - rho*W.
+    """
+    nobs = W.shape[0]
+    if method == "eigen":
+        B = W.dot(linalg.inv(np.eye(nobs) - rho*W.toarray()))
+        return np.trace(B), np.sum(B*B.T), np.sum(B**2)
+
+    rng = np.random.default_rng(seed)
+    x = rng.choice([-1.0, 1.0], size=(nobs, probes))
+    lu = splinalg.splu((sparse.identity(nobs, format="csc") - rho*W).tocsc())
+    Bx = W.dot(lu.solve(x))
+    BtX = lu.solve(W.T.dot(x), trans="T")
+    return np.mean(np.sum(x*Bx, axis=0)), np.mean(np.sum(BtX*Bx, axis=0)), np.mean(np.sum(Bx**2, axis=0))
+
+# maximum likelihood spatial lag model
+def ml_lag(y, X, w, method="auto", se=False, tol=1e-7, vm=False):
+    """
+    Estimates the spatial lag model y = rho*Wy + X*beta + e by maximum likelihood
+        The likelihood is concentrated on rho: with the OLS residuals e0 of y and
+        eL of Wy on X, every evaluation only needs (e0 - rho*eL)'(e0 - rho*eL)
+        and the cached log-determinant (see log_determinant), which makes the
+        optimization cheap also for large N. Adding WX to X gives the spatial
+        Durbin model. Equivalent to spreg.ML_Lag(y, X, w=w).
+
+    Inputs:
+        - y: array of shape (N,) or (N, R)
+        - X: array of shape (N, k), or (R, N, k) with one design per column of y
+        - w: libpysal weights object (used with its current transform, e.g. "r")
+        - method: method of the log-determinant, see log_determinant
+        - se: whether to also return the standard errors (from the information matrix)
+        - tol: tolerance of rho
+        - vm: whether to also return the covariance matrix of the betas (with se=True,
+          single outcome only)
+
+    Returns: betas (array of shape (k+2,) or (k+2, R), ordered constant, X, W_Y),
+        std_err (same shape) if se=True and vm (array (k+2, k+2)) if vm=True
+    """
+    y = np.asarray(y, dtype=float)
+    X = _design(X, add_constant=True)
+    if y.ndim == 2: #one fit per replication
+        designs = X if X.ndim == 3 else [X]*y.shape[1]
+        results = [ml_lag(y[:, r], designs[r][:, 1:], w, method=method, se=se, tol=tol)
+                   for r in range(y.shape[1])]
+        if se:
+            return (np.column_stack([result[0] for result in results]),
+                    np.column_stack([result[1] for result in results]))
+        return np.column_stack(results)
+
+    W = w.sparse.tocsr()
+    nobs, k = X.shape
+    logdet = log_determinant(w, method=method)
+
+    # residuals of y and Wy on X
+    Q, R = np.linalg.qr(X)
+    Wy = W.dot(y)
+    b0, bL = linalg.solve_triangular(R, Q.T.dot(np.column_stack([y, Wy]))).T
+    e0, eL = y - X.dot(b0), Wy - X.dot(bL)
+
+    def negative_loglik(rho):
+        u = e0 - rho*eL
+        return nobs/2*np.log(u.dot(u)/nobs) - logdet(rho)
+
+    rho = optimize.minimize_scalar(negative_loglik, bounds=(-0.999, 0.999), method="bounded",
+                                   options={"xatol": tol}).x
+    beta = b0 - rho*bL
+    betas = np.append(beta, rho)
+
+    if not se:
+        return betas
+
+    # information matrix of (beta, rho, sigma2)
+    u = e0 - rho*eL
+    sigma2 = u.dot(u)/nobs
+    tr1, tr2, tr3 = _lag_traces(W, rho, _logdet_method(W, method))
+    lu = splinalg.splu((sparse.identity(nobs, format="csc") - rho*W).tocsc())
+    wpredy = W.dot(lu.solve(X.dot(beta))) #W(I - rho*W)^-1 X beta
+    xwpredy = X.T.dot(wpredy)
+
+    info = np.zeros((k + 2, k + 2))
+    info[:k, :k] = X.T.dot(X)/sigma2
+    info[:k, k] = info[k, :k] = xwpredy/sigma2
+    info[k, k] = tr2 + tr3 + wpredy.dot(wpredy)/sigma2
+    info[k, k + 1] = info[k + 1, k] = tr1/sigma2
+    info[k + 1, k + 1] = nobs/(2*sigma2**2)
+    cov = linalg.inv(info)[:-1, :-1]
+    std_err = np.sqrt(np.diag(cov))
+
+    if vm:
+        return betas, std_err, cov
+    return betas, std_err
+
+# impacts of the spatial lag and Durbin model
+def spatial_impacts(betas, vm, w, variables, draws=1000, order=100, probes=50, seed=None, max_rho=0.95):
+    """
+    Direct, indirect and total impacts of the regressors of a spatial lag or Durbin model
+        The impact matrix of a variable with coefficient beta (on X) and theta (on WX)
+        is S = (I - rho*W)^-1 (beta*I + theta*W) = sum_j rho^j (beta*W^j + theta*W^(j+1)).
+        The direct impact is tr(S)/N, computed from the cached Monte Carlo traces of
+        the powers of W (see power_traces), the total impact is the mean row sum of S,
+        computed exactly from the row sums of the powers, and the indirect impact is
+        the difference (LeSage and Pace, 2009). The power series is truncated at order
+        and only converges for |rho| < 1; for |rho| >= max_rho, where the truncation
+        error is no longer negligible, the impacts are missing.
+        Inference simulates the coefficients from N(betas, vm); all draws are
+        evaluated at once as a matrix of powers of rho. Draws with |rho| >= max_rho
+        are discarded, their number is kept in results.attrs["discarded"].
+
+    Inputs:
+        - betas: coefficients (constant, X, W_Y) as returned by spatial_2sls or ml_lag
+        - vm: covariance matrix of betas
+        - w: libpysal weights object (used with its current transform, e.g. "r")
+        - variables: dictionary name -> (index of beta or None, index of theta or None),
+          the positions in betas of the variable and of its spatial lag
+        - draws: number of simulated coefficient vectors (0: no inference)
+        - order: order of the power series
+        - probes: number of random vectors of the trace estimate
+        - seed: seed of the draws
+        - max_rho: largest |rho| for which the impacts are computed
+
+    Returns: impacts (DataFrame with index (variable, impact) and columns
+        estimate, std_err, p-value)
+    """
+    W = w.sparse.tocsr()
+    nobs = W.shape[0]
+    betas = np.asarray(betas, dtype=float)
+
+    # mean diagonal and mean row sum of W^j, j = 0, ..., order + 1
+    diagonal = np.concatenate([[1.0], power_traces(w, order=order + 1, probes=probes)/nobs])
+    row_sum = np.empty(order + 2)
+    block = np.ones(nobs)
+    for j in range(order + 2):
+        row_sum[j] = block.mean()
+        block = W.dot(block)
+
+    def impacts(coefficients):
+        """
+        Direct and total impacts of all variables for coefficient vectors (D, k+2)
+        """
+        rho = coefficients[:, -1]
+        powers = np.power.outer(rho, np.arange(order + 1)) #(D, order+1)
+        results = []
+        for beta_index, theta_index in variables.values():
+            beta = coefficients[:, beta_index] if beta_index is not None else 0.0
+            theta = coefficients[:, theta_index] if theta_index is not None else 0.0
+            direct = beta*powers.dot(diagonal[:-1]) + theta*powers.dot(diagonal[1:])
+            total = beta*powers.dot(row_sum[:-1]) + theta*powers.dot(row_sum[1:])
+            results.append(np.column_stack([direct, total - direct, total]))
+        results = np.stack(results, axis=1) #(D, variables, 3)
+        results[np.abs(rho) >= max_rho] = np.nan #the truncated series does not converge
+        return results
+
+    estimate = impacts(betas[np.newaxis])[0]
+    index = pd.MultiIndex.from_product([list(variables), ["Direct", "Indirect", "Total"]],
+                                       names=["variable", "impact"])
+    results = pd.DataFrame({"estimate": estimate.ravel()}, index=index)
+    if not draws:
+        return results
+
+    # simulated coefficients, draws with rho close to or beyond one are discarded
+    rng = np.random.default_rng(seed)
+    simulated = rng.multivariate_normal(betas, vm, size=draws, method="cholesky")
+    keep = np.abs(simulated[:, -1]) < max_rho
+    results.attrs["discarded"] = int(draws - keep.sum())
+    std_err = impacts(simulated[keep]).std(axis=0)
+
+    results["std_err"] = np.where(np.isnan(estimate.ravel()), np.nan, std_err.ravel())
+    results["p-value"] = 2*stats.norm.sf(np.abs(results["estimate"]/results["std_err"]))
+
+    return results
+
+# container for the results of the array estimators (pandas objects indexed by regressor)
+FitResult = namedtuple("FitResult", ["params", "bse", "pvalues", "cov", "nobs", "df_resid"])
+
+# within transformation
+def demean(X, codes, tol=1e-10, maxiter=1000):
+    """
+    Removes one or more fixed effects from the columns of X by iterative demeaning
+        With one fixed effect a single pass is exact. With several, the group
+        means are subtracted alternately until the largest change is below tol
+        (method of alternating projections).
+
+    Inputs:
+        - X: array of shape (N, k)
+        - codes: list of integer arrays (N,) with the group of every observation (0, ..., G-1)
+
+    Returns: X_tilde (array of shape (N, k))
+    """
+    X = np.array(X, dtype=float)
+    counts = [np.bincount(c).astype(float) for c in codes]
+
+    for _ in range(maxiter):
+        change = 0.0
+        for c, n in zip(codes, counts):
+            for j in range(X.shape[1]):
+                means = np.bincount(c, weights=X[:, j])/n
+                X[:, j] -= means[c]
+                change = max(change, np.max(np.abs(means)))
+        if len(codes) <= 1 or change < tol:
+            break
+
+    return X
+
+def _cluster_meat(scores, groups):
+    """
+    Sum of the outer products of the per-cluster score sums
+
+    Inputs:
+        - scores: array of shape (N, k), regressor times residual
+        - groups: integer array (N,) with the cluster of every observation
+
+    Returns: meat (array of shape (k, k)), number of clusters
+    """
+    n_groups = groups.max() + 1
+    sums = np.zeros((n_groups, scores.shape[1]))
+    np.add.at(sums, groups, scores)
+    return sums.T.dot(sums), n_groups
+
+def conley_kernel(lon, lat, cutoff, kernel="uniform"):
+    """
+    Sparse spatial kernel of the Conley covariance
+        The pairs within cutoff are found with a KD-tree on the unit sphere, where
+        the great circle distance d corresponds to the chord 2*sin(d/2R), so only
+        the pairs within the cutoff are ever formed. Observations at the same
+        location (e.g. the same unit in several years) have weight one. As for any
+        truncated kernel, the resulting covariance is not guaranteed to be positive
+        definite (missing standard errors).
+
+    Inputs:
+        - lon, lat: coordinates in degrees (N,)
+        - cutoff: distance cutoff in km
+        - kernel: "uniform" (weight one within the cutoff) or "bartlett" (1 - d/cutoff)
+
+    Returns: K (sparse symmetric matrix (N, N) with ones on the diagonal)
+    """
+    lon, lat = np.radians(lon), np.radians(lat)
+    points = np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+    nobs = len(points)
+
+    tree = spatial.cKDTree(points)
+    pairs = tree.query_pairs(2*np.sin(min(cutoff/EARTH_RADIUS, np.pi)/2), output_type="ndarray")
+    chord = np.linalg.norm(points[pairs[:, 0]] - points[pairs[:, 1]], axis=1)
+    distance = 2*EARTH_RADIUS*np.arcsin(np.minimum(chord/2, 1))
+
+    if kernel == "uniform":
+        weights = np.ones(len(pairs))
+    elif kernel == "bartlett":
+        weights = 1 - distance/cutoff
+    else:
+        raise ValueError(f"Unknown kernel {kernel}")
+
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(nobs)])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(nobs)])
+    return sparse.csr_matrix((np.concatenate([weights, weights, np.ones(nobs)]), (rows, cols)),
+                             shape=(nobs, nobs))
+
+def _fit_ols(Y, X, names, n_absorbed, cov_type, groups, use_t, bootstrap=None, kernel=None):
+    """
+    OLS on (demeaned) arrays with non-robust, HC1, clustered or Conley covariance
+        bootstrap: None or (reps, seed, workers), replaces the p-values of a
+        clustered fit by wild cluster bootstrap p-values
+        kernel: sparse spatial kernel of the Conley covariance (see conley_kernel)
+
+    Returns: FitResult
+    """
+    nobs, k = X.shape
+    df_model = k + n_absorbed
+
+    params = linalg.lstsq(X, Y)[0]
+    resid = Y - X.dot(params)
+    bread = linalg.pinvh(X.T.dot(X))
+
+    if cov_type == "cluster":
+        meat, n_groups = _cluster_meat(X*resid[:, np.newaxis], groups)
+        correction = n_groups/(n_groups - 1)*(nobs - 1)/(nobs - df_model)
+        cov = correction*bread.dot(meat).dot(bread)
+        df_resid = n_groups - 1 #as statsmodels for clustered inference
+    elif cov_type == "HC1":
+        scores = X*resid[:, np.newaxis]
+        cov = nobs/(nobs - df_model)*bread.dot(scores.T.dot(scores)).dot(bread)
+        df_resid = nobs - df_model
+    elif cov_type == "conley":
+        #spatial HAC: sum of K_ij s_i s_j' over the pairs in the sparse kernel
+        scores = X*resid[:, np.newaxis]
+        meat = scores.T.dot(kernel.dot(scores))
+        cov = nobs/(nobs - df_model)*bread.dot(meat).dot(bread)
+        df_resid = nobs - df_model
+    elif cov_type == "nonrobust":
+        df_resid = nobs - df_model
+        cov = bread*resid.dot(resid)/df_resid
+    else:
+        raise ValueError(f"Unknown cov_type {cov_type}")
+
+    bse = np.sqrt(np.diag(cov))
+    if use_t:
+        pvalues = 2*stats.t.sf(np.abs(params/bse), df_resid)
+    else:
+        pvalues = 2*stats.norm.sf(np.abs(params/bse))
+
+    if bootstrap is not None and cov_type == "cluster":
+        reps, seed, workers = bootstrap
+        pvalues = wild_cluster_bootstrap(Y, X, groups, reps=reps, seed=seed, workers=workers)
+
+    return FitResult(params=pd.Series(params, index=names),
+                     bse=pd.Series(bse, index=names),
+                     pvalues=pd.Series(pvalues, index=names),
+                     cov=pd.DataFrame(cov, index=names, columns=names),
+                     nobs=nobs,
+                     df_resid=df_resid)
+
+# wild cluster bootstrap
+def wild_cluster_bootstrap(Y, X, groups, reps=9999, weights="rademacher", seed=None,
+                           workers=1, batch_size=1000):
+    """
+    Wild cluster restricted bootstrap p-values of all coefficients (H0: beta_j = 0)
+        For every coefficient the restricted fit (without regressor j) is computed
+        once. The bootstrap t-statistics of all replications are then obtained from
+        matrix products over the cluster level score sums X_g'u_g and cross products
+        X_g'X_g, without refitting: with weights v (clusters x draws) the bootstrap
+        coefficient is C[j]v and the cluster scores are d*v - M(Cv) with the (clusters, k)
+        matrix M = sum_l X_g'X_g[:, l] bread[j, l], so a batch of B draws costs
+        O(clusters*k*B) without any clusters x clusters matrix. The draws are split
+        into batches with their own spawned seed, which can run on a thread pool
+        and give the same result for any number of workers.
+        X should be demeaned if fixed effects were absorbed.
+
+    Inputs:
+        - Y: outcome (N,)
+        - X: regressors (N, k)
+        - groups: integer array (N,) with the cluster of every observation
+        - reps: number of bootstrap replications
+        - weights: "rademacher" (+-1) or "webb" (six point distribution)
+        - seed: seed (integer or SeedSequence)
+        - workers: number of threads
+        - batch_size: replications per batch
+
+    Returns: pvalues (array (k,), symmetric, share of |t*| >= |t|)
+    """
+    nobs, k = X.shape
+    n_groups = groups.max() + 1
+    cluster_sum = sparse.csr_matrix((np.ones(nobs), (groups, np.arange(nobs))), shape=(n_groups, nobs))
+
+    bread = linalg.pinvh(X.T.dot(X))
+    # cross products X_g'X_g of every cluster (n_groups, k, k)
+    cross = cluster_sum.dot((X[:, :, np.newaxis]*X[:, np.newaxis, :]).reshape(nobs, k*k)).reshape(n_groups, k, k)
+
+    # statistics of the original sample (the small sample correction cancels)
+    params = bread.dot(X.T.dot(Y))
+    scores = cluster_sum.dot(X*(Y - X.dot(params))[:, np.newaxis])
+    t_stat = params/np.sqrt(np.sum(scores.dot(bread)**2, axis=0))
+
+    # pieces of the restricted fits, one per coefficient
+    pieces = []
+    for j in range(k):
+        keep = [i for i in range(k) if i != j]
+        resid = Y - X[:, keep].dot(linalg.lstsq(X[:, keep], Y)[0]) #restricted residuals
+        S = cluster_sum.dot(X*resid[:, np.newaxis]) #(n_groups, k)
+        C = bread.dot(S.T) #(k, n_groups), bootstrap coefficients are C v
+        d = S.dot(bread[j])
+        M = np.einsum("gkl,l->gk", cross, bread[j]) #(n_groups, k)
+        pieces.append((C, d, M))
+
+    def exceed(args):
+        size, batch_seed = args
+        rng = np.random.default_rng(batch_seed)
+        if weights == "rademacher":
+            V = rng.choice([-1.0, 1.0], size=(n_groups, size))
+        elif weights == "webb":
+            webb = np.sqrt([1.5, 1.0, 0.5])
+            V = rng.choice(np.concatenate([-webb, webb]), size=(n_groups, size))
+        else:
+            raise ValueError(f"Unknown weights {weights}")
+
+        counts = np.empty(k)
+        for j, (C, d, M) in enumerate(pieces):
+            CV = C.dot(V) #(k, size)
+            Q = d[:, np.newaxis]*V - M.dot(CV)
+            t_boot = CV[j]/np.sqrt(np.sum(Q**2, axis=0))
+            counts[j] = np.sum(np.abs(t_boot) >= np.abs(t_stat[j]))
+        return counts
+
+    counts = thread_map(exceed, spawn_batches(reps, batch_size, seed), workers)
+
+    return np.sum(counts, axis=0)/reps
+
+# batch of regression specifications
+def fit_specifications(data, y, specification, absorb=None, cluster=None, cov_type=None,
+                       use_t=True, workers=1, cache_dir=None, bootstrap=0, seed=None,
+                       coordinates=("lon", "lat"), cutoff=500, kernel="uniform"):
+    """
+    Fits all columns of a regression table from shared work
+        The design matrix of the union of all regressors is built once. Specifications
+        with the same estimation sample (rows without missing values in their
+        variables) share one within transformation of the fixed effects, each column
+        then only selects its regressors from the demeaned matrix. The fits can run
+        on a thread pool.
+        Every column equals smf.ols("y ~ regressors + C(fe) -1") with the chosen
+        covariance, see absorb_ols.
+
+    Inputs:
+        - data: data frame
+        - y: name of the outcome
+        - specification: dictionary with lists of regressors (one entry per column)
+        - absorb: list of fixed effect columns (None: estimate an intercept instead)
+        - cluster: column to cluster the standard errors on
+        - cov_type: "nonrobust", "HC1", "cluster" (default if cluster is given) or
+          "conley" (spatial HAC, see conley_kernel)
+        - use_t: t (True) or normal (False) distribution for the p-values
+        - workers: number of threads for fitting the specifications
+        - cache_dir: directory of the result cache (see result_cache), None for no caching;
+          bootstrap results are only cached with a seed
+        - bootstrap: number of wild cluster bootstrap replications for the p-values
+          of clustered fits (0: analytic p-values), see wild_cluster_bootstrap
+        - seed: seed of the bootstrap
+        - coordinates: longitude and latitude columns (conley)
+        - cutoff: distance cutoff in km (conley)
+        - kernel: "uniform" or "bartlett" (conley)
+
+    Returns: results (dictionary with one FitResult per specification key)
+    """
+    absorb = list(absorb or [])
+    if cov_type is None:
+        cov_type = "nonrobust" if cluster is None else "cluster"
+
+    #a regressor listed twice enters once, as in a formula
+    specs = {key: list(dict.fromkeys(regressors)) for key, regressors in specification.items()}
+    union = list(dict.fromkeys(regressor for regressors in specs.values() for regressor in regressors))
+    base = list(dict.fromkeys([y] + absorb + ([cluster] if cluster is not None else [])
+                              + (list(coordinates) if cov_type == "conley" else [])))
+    df = data[list(dict.fromkeys(base + union))]
+
+    if cache_dir is not None and not (bootstrap and seed is None):
+        #keyed by the code, the used columns of the data, the specification and the options
+        key = {"estimator": "fit_specifications",
+               "code": ESTIMATION_FINGERPRINT,
+               "data": fingerprint_frame(df),
+               "y": y,
+               "specification": list(specs.items()),
+               "absorb": absorb,
+               "cluster": cluster,
+               "cov_type": cov_type,
+               "use_t": use_t,
+               "bootstrap": [bootstrap, seed]}
+        if cov_type == "conley":
+            key["conley"] = [list(coordinates), cutoff, kernel]
+        return cached_result(key, lambda: fit_specifications(df, y, specification, absorb=absorb,
+                                                             cluster=cluster, cov_type=cov_type,
+                                                             use_t=use_t, workers=workers,
+                                                             bootstrap=bootstrap, seed=seed,
+                                                             coordinates=coordinates, cutoff=cutoff,
+                                                             kernel=kernel),
+                             cache_dir=cache_dir)
+
+    # estimation sample per specification, specifications with equal samples share the work
+    complete = df.notna()
+    complete_base = complete[base].all(axis=1).to_numpy()
+    samples = {}
+    for key, regressors in specs.items():
+        mask = complete_base & complete[regressors].all(axis=1).to_numpy()
+        samples.setdefault(mask.tobytes(), (mask, []))[1].append(key)
+
+    tasks = []
+    for mask, keys in samples.values():
+        sub = df[mask]
+        columns = list(dict.fromkeys(regressor for key in keys for regressor in specs[key]))
+        Z = sub[[y] + columns].to_numpy(dtype=float)
+
+        if absorb:
+            codes = [pd.factorize(sub[fe])[0] for fe in absorb]
+            Z = demean(Z, codes)
+            n_absorbed = sum(c.max() + 1 for c in codes) - (len(codes) - 1)
+        else:
+            Z = np.hstack([Z, np.ones((len(sub), 1))])
+            columns = columns + ["Intercept"]
+            n_absorbed = 0
+
+        groups = pd.factorize(sub[cluster])[0] if cluster is not None else None
+        options = {}
+        if cov_type == "conley": #one kernel per estimation sample
+            options["kernel"] = conley_kernel(sub[coordinates[0]].to_numpy(dtype=float),
+                                              sub[coordinates[1]].to_numpy(dtype=float),
+                                              cutoff, kernel=kernel)
+        position = {name: j + 1 for j, name in enumerate(columns)}
+        for key in keys:
+            names = specs[key] if absorb else ["Intercept"] + specs[key]
+            X = Z[:, [position[name] for name in names]]
+            tasks.append((key, [Z[:, 0], X, names, n_absorbed, cov_type, groups, use_t], dict(options)))
+
+    if bootstrap:
+        #every specification gets its own stream, independent of the thread pool
+        for (_, _, options), task_seed in zip(tasks, seed_sequence(seed).spawn(len(tasks))):
+            options["bootstrap"] = (bootstrap, task_seed, workers)
+
+    fits = thread_map(lambda task: _fit_ols(*task[1], **task[2]), tasks, workers)
+
+    results = {key: fit for (key, _, _), fit in zip(tasks, fits)}
+
+    return {key: results[key] for key in specification.keys()}
+
+# OLS with absorbed fixed effects
+def absorb_ols(data, y, regressors, absorb=None, cluster=None, cov_type=None, use_t=True,
+               bootstrap=0, seed=None):
+    """
+    OLS with fixed effects absorbed by the within transformation
+        Gives the same slope coefficients and (clustered) standard errors as
+        smf.ols("y ~ regressors + C(fe) -1").fit(cov_type='cluster', use_t=True)
+        without building the dummy columns. Rows with missing values in any of the
+        variables are dropped once, before estimation. The degrees of freedom count
+        the absorbed levels as parameters (like the dummies), which is exact for one
+        fixed effect and assumes a connected design for several.
+        Without fixed effects an intercept is estimated.
+
+    Inputs:
+        - data: data frame
+        - y: name of the outcome
+        - regressors: list of column names
+        - absorb: list of fixed effect columns (or None)
+        - cluster: column to cluster the standard errors on
+        - cov_type: "nonrobust", "HC1", "cluster" (default if cluster is given) or
+          "conley" (with the default coordinates and cutoff of fit_specifications)
+        - use_t: t (True) or normal (False) distribution for the p-values
+        - bootstrap, seed: wild cluster bootstrap p-values of a clustered fit,
+          see fit_specifications
+
+    Returns: FitResult (params, bse, pvalues, cov, nobs, df_resid)
+    """
+    return fit_specifications(data, y, {"": regressors}, absorb=absorb, cluster=cluster,
+                              cov_type=cov_type, use_t=use_t, bootstrap=bootstrap, seed=seed)[""]
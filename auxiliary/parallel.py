@@ -0,0 +1,43 @@
+"""This module contains auxiliary functions for splitting random draws into seeded batches and running them on a thread pool, which are used by the bootstrap, the permutation tests and the simulation runner."""
+
+#Packages
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def seed_sequence(seed):
+    """
+    Returns: seed as numpy SeedSequence (integers and None are converted)
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+def spawn_batches(total, batch_size, seed):
+    """
+    Splits total draws into batches with their own spawned seed
+        The batches only depend on total, batch_size and seed, so results
+        computed from them do not depend on where or in which order the
+        batches are run.
+
+    Inputs:
+        - total: number of draws (replications, permutations, ...)
+        - batch_size: draws per batch (the last batch may be smaller)
+        - seed: seed (integer or SeedSequence)
+
+    Returns: batches (list of (size, SeedSequence))
+    """
+    sizes = [min(batch_size, total - start) for start in range(0, total, batch_size)]
+    return list(zip(sizes, seed_sequence(seed).spawn(len(sizes))))
+
+def thread_map(function, tasks, workers=1):
+    """
+    Applies function to all tasks, on a thread pool if workers > 1
+
+    Returns: results (list, in the order of the tasks)
+    """
+    if workers == 1:
+        return [function(task) for task in tasks]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, tasks))
@@ -0,0 +1,152 @@
+"""This module contains auxiliary functions for caching fitted regression results on disk, which are used by the regression tables, and the in-memory cache of the weights and their derived quantities."""
+
+#Packages
+import hashlib
+import json
+import os
+import pickle
+from collections import OrderedDict
+
+import pandas as pd
+import numpy as np
+
+
+# location and maximum size of the cache
+RESULT_CACHE_PATH = "data/cache/results"
+RESULT_CACHE_BYTES = 64*2**20
+
+# in-memory cache
+class LRUCache(OrderedDict):
+    """
+    Dictionary with at most maxsize entries, the least recently used ones are evicted
+        lookup marks an entry as recently used, store adds an entry and evicts.
+    """
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def lookup(self, key, default=None):
+        """
+        Returns: the entry of key (default if there is none)
+        """
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def store(self, key, value):
+        """
+        Returns: value, after adding it as the most recently used entry
+        """
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+        return value
+
+# fingerprints
+def fingerprint_frame(data, columns=None):
+    """
+    Hash of the content of a data frame (only the given columns)
+        Covers the values, the index, the column names and the dtypes, so any
+        change of the data used by a regression changes the fingerprint.
+
+    Returns: fingerprint (hex string)
+    """
+    if columns is not None:
+        data = data[list(dict.fromkeys(columns))]
+    sha = hashlib.sha256()
+    sha.update(json.dumps([[str(name), str(dtype)] for name, dtype in data.dtypes.items()]).encode())
+    sha.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    return sha.hexdigest()
+
+def fingerprint_weights(w):
+    """
+    Hash of a libpysal weights object (neighbors, weights and transform)
+
+    Returns: fingerprint (hex string)
+    """
+    W = w.sparse.tocsr()
+    sha = hashlib.sha256()
+    sha.update(str(w.transform).encode())
+    for array in (W.indptr, W.indices, W.data):
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+def fingerprint_source(*paths):
+    """
+    Hash of source files, part of the cache keys so that results of older code are not reused
+
+    Returns: fingerprint (hex string)
+    """
+    sha = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def _evict(cache_dir, max_bytes):
+    """
+    Removes the least recently used entries until the cache fits into max_bytes
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".pkl"):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        total -= size
+
+# cached computation
+def cached_result(key, compute, cache_dir=RESULT_CACHE_PATH, max_bytes=RESULT_CACHE_BYTES):
+    """
+    Returns the result of compute() from the disk cache if it has been stored before
+        The entry is identified by a hash of key, which should contain the
+        fingerprint of the data together with the specification and all options.
+        Entries used last are kept when the cache exceeds max_bytes.
+
+    Inputs:
+        - key: json serializable description of the computation
+        - compute: function without arguments, called on a cache miss
+        - cache_dir: directory of the cache (None: no caching)
+
+    Returns: result of compute()
+    """
+    if cache_dir is None:
+        return compute()
+
+    name = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+    path = os.path.join(cache_dir, f"{name}.pkl")
+
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            os.utime(path) #mark as recently used
+            return result
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass #unreadable entry, compute again
+
+    result = compute()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(result, f)
+    os.replace(path + ".tmp", path)
+    _evict(cache_dir, max_bytes)
+
+    return result
+
+def clear_result_cache(cache_dir=RESULT_CACHE_PATH):
+    """
+    Removes all entries of the cache
+    """
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.endswith(".pkl"):
+                os.remove(os.path.join(cache_dir, name))
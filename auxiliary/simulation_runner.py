@@ -0,0 +1,213 @@
+"""This module contains the runner for the Monte Carlo experiments of the simulation study - which has a seperate notebook"""
+
+#Packages
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+
+from auxiliary.estimation import fast_ols, ml_lag, spatial_2sls
+from auxiliary.parallel import seed_sequence, spawn_batches
+from auxiliary.simulations import simulate_batch
+from auxiliary.simulation_store import *
+from auxiliary.spatial_weights import grid_shape, get_grid_weights
+
+
+# regressors of the spatial two-stage regression per design
+SPATIAL_REGRESSORS = {"SpatialLag": ["X", "D"],
+                      "SDM": ["X", "D", "WD"],
+                      "backdoor": ["X", "D", "WD"]}
+
+# estimate one chunk of replications
+def simulate_chunk(design, num_obs, n_reps, seed, knn=10, estimator="gm", stencil=False, **params):
+    """
+    Simulates and estimates a chunk of replications of one design
+        The samples are drawn with simulate_batch from their own random stream,
+        so the result only depends on the seed and not on the worker running it.
+
+    Inputs:
+        - design: one of "SLX", "SpatialLag", "SDM" or "backdoor"
+        - num_obs: number of observations (or grid shape)
+        - n_reps: number of replications in the chunk
+        - seed: numpy SeedSequence of the chunk
+        - estimator: estimator of the spatial models, "gm" (two stage, as spreg.GM_Lag)
+          or "ml" (maximum likelihood, as spreg.ML_Lag)
+        - stencil: build the weight matrix from the lattice (see get_grid_weights)
+        - knn, params: passed on to simulate_batch
+
+    Returns: estimates (array of shape (n_reps, 3), columns ATE, Non-spatial, spatial)
+    """
+    sample, _ = simulate_batch(design, num_obs, n_reps, knn=knn, seed=seed, stencil=stencil, **params)
+
+    # regressors of all replications stacked as (n_reps, N, k)
+    def regressors(names):
+        return np.stack([sample[name].T for name in names], axis=-1)
+
+    estimates = np.empty((n_reps, 3))
+    estimates[:, 0] = (sample["Y_1"] - sample["Y_0"]).mean(axis=0) #ATE
+    estimates[:, 1] = fast_ols(sample["Y"], regressors(["X", "D"]))[2] #"Y ~ X + D"
+
+    if design == "SLX":
+        estimates[:, 2] = fast_ols(sample["Y"], regressors(["X", "D", "WD"]))[2] #"Y ~ X + D + WD"
+    elif estimator == "ml":
+        #maximum likelihood on the row standardized matrix, the log-determinant is shared by all chunks
+        w = get_grid_weights(*grid_shape(num_obs), knn=knn, transform="R", stencil=stencil)
+        estimates[:, 2] = ml_lag(sample["Y"], regressors(SPATIAL_REGRESSORS[design]), w)[2]
+    elif estimator == "gm":
+        #spatial 2 stage on the row standardized matrix (as spreg.GM_Lag with w_lags=1)
+        w = get_grid_weights(*grid_shape(num_obs), knn=knn, transform="R", stencil=stencil)
+        estimates[:, 2] = spatial_2sls(sample["Y"], regressors(SPATIAL_REGRESSORS[design]), w, w_lags=1)[2]
+    else:
+        raise ValueError(f"Unknown estimator {estimator}")
+
+    return estimates
+
+def _simulate_chunk(args):
+    """
+    Unpacks the arguments of simulate_chunk for the process pool
+    """
+    design, num_obs, n_reps, seed, params = args
+    return simulate_chunk(design, num_obs, n_reps, seed, **params)
+
+def _chunk_tasks(design, num_obs, n_sims, seed, chunk_size, params):
+    """
+    Splits n_sims replications into chunks with their own spawned seed
+    """
+    return [(design, num_obs, size, chunk_seed, params)
+            for size, chunk_seed in spawn_batches(n_sims, chunk_size, seed)]
+
+def _run_tasks(tasks, workers):
+    """
+    Yields the estimates of the chunks in order, as soon as they are available
+    """
+    if workers == 1:
+        for task in tasks:
+            yield _simulate_chunk(task)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for estimates in executor.map(_simulate_chunk, tasks): #keeps the order of the chunks
+                yield estimates
+
+# run the replications of one experiment
+def run_replications(design, num_obs, n_sims, seed=None, workers=1, chunk_size=10, **params):
+    """
+    Runs n_sims replications of a design, optionally on a process pool
+        The replications are split into chunks of chunk_size and every chunk
+        gets its own stream spawned from SeedSequence(seed). Chunks do not
+        depend on the number of workers, hence the results are identical
+        for any worker count.
+
+    Inputs:
+        - design: one of "SLX", "SpatialLag", "SDM" or "backdoor"
+        - num_obs: number of observations (or grid shape)
+        - n_sims: number of replications
+        - seed: base seed (integer or SeedSequence)
+        - workers: number of processes (1 runs in the current process)
+        - chunk_size: replications simulated together
+        - params: passed on to simulate_chunk and simulate_batch (estimator, knn, beta, gamma, rho, ...)
+
+    Returns: estimates (DataFrame with one row per replication)
+    """
+    tasks = _chunk_tasks(design, num_obs, n_sims, seed_sequence(seed), chunk_size, params)
+    chunks = list(_run_tasks(tasks, workers))
+
+    estimates = pd.DataFrame(np.vstack(chunks), columns=ESTIMATES)
+
+    return estimates
+
+def store_replications(design, num_obs, n_sims, store=STORE_PATH, run_id=None, seed=None,
+                       workers=1, chunk_size=10, experiment=None, **params):
+    """
+    Runs n_sims replications of a design and streams the estimates to the store
+        Every finished chunk is written to its own file (see simulation_store),
+        together with the metadata of the run. Calling the function again with
+        the same arguments resumes an interrupted run from the last completed
+        chunk; since every chunk has its own seed, the result is the same as
+        for an uninterrupted run. Without a seed, a resumed run continues with
+        the seed stored in its metadata and a new run draws a fresh one.
+
+    Inputs:
+        - store: directory of the store
+        - run_id: name of the run (default: design, num_obs, n_sims and experiment)
+        - experiment: label of the experiment ("Sim1", "Sim2" or "Sim3"), which
+          column of the table of get_simulation_results the run replaces
+        - remaining inputs: see run_replications
+
+    Returns: run_dir (string)
+    """
+    if experiment is None:
+        raise ValueError("A stored run needs the label of its experiment (e.g. experiment='Sim1')")
+
+    if run_id is None:
+        run_id = f"{design}_{experiment}_N{num_obs}_R{n_sims}"
+    if seed is None:
+        seed = stored_seed(store, run_id)
+    seed = seed_sequence(seed)
+
+    tasks = _chunk_tasks(design, num_obs, n_sims, seed, chunk_size, params)
+    metadata = {"design": design,
+                "experiment": experiment,
+                "num_obs": num_obs,
+                "n_sims": n_sims,
+                "chunk_size": chunk_size,
+                "n_chunks": len(tasks),
+                "seed": {"entropy": seed.entropy, "spawn_key": seed.spawn_key},
+                "parameters": params,
+                "workers": workers}
+    run_dir = open_run(store, run_id, metadata)
+
+    # only run the chunks which are not stored yet
+    done = completed_chunks(run_dir)
+    todo = [index for index in range(len(tasks)) if index not in done]
+    for index, estimates in zip(todo, _run_tasks([tasks[index] for index in todo], workers)):
+        write_chunk(run_dir, index, estimates, first_replication=index*chunk_size)
+
+    return run_dir
+
+def run_simulation(design, num_obs, n_sims, seed=None, workers=1, store=None, experiment=None, **params):
+    """
+    Runs one experiment of the simulation study
+
+    Inputs: see run_replications, if store is given the replications are
+        written to the store with the label experiment (see store_replications)
+
+    Returns: summary (Series with the mean of ATE, Non-spatial and spatial)
+    """
+    if store is not None:
+        run_dir = store_replications(design, num_obs, n_sims, store=store, seed=seed, workers=workers,
+                                     experiment=experiment, **params)
+        return summarize_run(run_dir)
+
+    estimates = run_replications(design, num_obs, n_sims, seed=seed, workers=workers, **params)
+
+    return estimates.mean()
+
+def run_simulation_study(design, n_obs, n_sims, seed=None, workers=1, store=None, **params):
+    """
+    Runs the experiments of one design for several sample sizes
+        The result has the layout of the csv files read by get_simulation_results,
+        e.g. run_simulation_study("SDM", [100, 100, 2500], [1, 100, 100], seed=123)
+
+    Inputs:
+        - design: one of "SLX", "SpatialLag", "SDM" or "backdoor"
+        - n_obs: list with the number of observations per experiment
+        - n_sims: list with the number of replications per experiment
+        - seed: base seed, every experiment gets its own stream
+        - store: directory of the store, if the replications should be kept
+          (e.g. STORE_PATH, which get_simulation_results reads)
+
+    Returns: df (DataFrame with index ATE, Non-spatial, spatial and columns Sim1, Sim2, ...)
+    """
+    if seed is None and store is not None:
+        #stored experiments without a seed resume with their own (see store_replications)
+        seeds = [None]*len(n_obs)
+    else:
+        seeds = seed_sequence(seed).spawn(len(n_obs))
+    columns = [f"Sim{i + 1}" for i in range(len(n_obs))]
+
+    df = pd.DataFrame(index=ESTIMATES)
+    for column, num_obs, n, experiment_seed in zip(columns, n_obs, n_sims, seeds):
+        df[column] = run_simulation(design, num_obs, n, seed=experiment_seed, workers=workers,
+                                    store=store, experiment=column, **params)
+
+    return df
@@ -0,0 +1,153 @@
+"""This module contains auxiliary functions for storing the results of the simulation study on disk."""
+
+#Packages
+import json
+import os
+import time
+
+import pandas as pd
+import numpy as np
+
+
+# default location of the simulation runs
+STORE_PATH = "data/simulations"
+
+ESTIMATES = ["ATE", "Non-spatial", "spatial"]
+
+# metadata keys that do not have to match when resuming a run
+_VOLATILE_METADATA = ("created", "workers")
+
+def _chunk_path(run_dir, index):
+    return os.path.join(run_dir, f"chunk_{index:06d}.parquet")
+
+def _to_json(value):
+    """
+    Converts numpy scalars and tuples in the metadata for json
+    """
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+# open a run
+def open_run(store, run_id, metadata):
+    """
+    Creates the directory of a run or reopens it for resuming
+        A run consists of metadata.json and one parquet file per chunk of
+        replications, which are written once and never modified.
+
+    Inputs:
+        - store: directory of the store
+        - run_id: name of the run
+        - metadata: dictionary (design, num_obs, n_sims, seed, parameters, ...)
+
+    Returns: run_dir (string)
+    """
+    run_dir = os.path.join(store, run_id)
+    path = os.path.join(run_dir, "metadata.json")
+    metadata = _to_json(metadata)
+
+    if os.path.exists(path):
+        existing = read_metadata(run_dir)
+        for key in set(existing) | set(metadata):
+            if key not in _VOLATILE_METADATA and existing.get(key) != metadata.get(key):
+                raise ValueError(f"Run {run_id} already exists with a different {key}")
+        return run_dir
+
+    os.makedirs(run_dir, exist_ok=True)
+    metadata = dict(metadata, created=time.strftime("%Y-%m-%d %H:%M:%S"))
+    with open(path + ".tmp", "w") as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+    return run_dir
+
+def read_metadata(run_dir):
+    """
+    Returns: metadata (dictionary) of a run
+    """
+    with open(os.path.join(run_dir, "metadata.json")) as f:
+        return json.load(f)
+
+def stored_seed(store, run_id):
+    """
+    Returns: seed of a stored run (numpy SeedSequence), None if the run does not exist
+    """
+    run_dir = os.path.join(store, run_id)
+    if not os.path.exists(os.path.join(run_dir, "metadata.json")):
+        return None
+    seed = read_metadata(run_dir)["seed"]
+    return np.random.SeedSequence(seed["entropy"], spawn_key=tuple(seed["spawn_key"]))
+
+def completed_chunks(run_dir):
+    """
+    Returns: set with the indices of the chunks already written
+    """
+    return {int(name[6:12]) for name in os.listdir(run_dir)
+            if name.startswith("chunk_") and name.endswith(".parquet")}
+
+def write_chunk(run_dir, index, estimates, first_replication):
+    """
+    Writes the estimates of one chunk of replications
+        The file is written under a temporary name and renamed afterwards, so
+        an interrupted job never leaves a partial chunk behind.
+
+    Inputs:
+        - run_dir: directory of the run
+        - index: index of the chunk
+        - estimates: array of shape (n_reps, 3) (ATE, Non-spatial, spatial)
+        - first_replication: number of the first replication in the chunk
+    """
+    df = pd.DataFrame(estimates, columns=ESTIMATES)
+    df.insert(0, "replication", np.arange(first_replication, first_replication + len(df)))
+
+    path = _chunk_path(run_dir, index)
+    df.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+def iter_chunks(run_dir):
+    """
+    Yields the estimates of a run chunk by chunk (DataFrames)
+    """
+    for index in sorted(completed_chunks(run_dir)):
+        yield pd.read_parquet(_chunk_path(run_dir, index))
+
+def is_complete(run_dir):
+    """
+    Returns: whether all chunks of a run have been written
+    """
+    return len(completed_chunks(run_dir)) == read_metadata(run_dir)["n_chunks"]
+
+def summarize_run(run_dir):
+    """
+    Computes the mean estimates of a run without loading all replications at once
+
+    Returns: summary (Series with the mean of ATE, Non-spatial and spatial)
+    """
+    total = np.zeros(len(ESTIMATES))
+    count = 0
+    for chunk in iter_chunks(run_dir):
+        total += chunk[ESTIMATES].to_numpy().sum(axis=0)
+        count += len(chunk)
+
+    return pd.Series(total/max(count, 1), index=ESTIMATES)
+
+def list_runs(store=STORE_PATH):
+    """
+    Lists the runs in the store
+
+    Returns: runs (DataFrame with the metadata, one row per run)
+    """
+    runs = []
+    if os.path.isdir(store):
+        for run_id in sorted(os.listdir(store)):
+            run_dir = os.path.join(store, run_id)
+            if os.path.exists(os.path.join(run_dir, "metadata.json")):
+                metadata = read_metadata(run_dir)
+                metadata.update(run_id=run_id, run_dir=run_dir, complete=is_complete(run_dir))
+                runs.append(metadata)
+
+    return pd.DataFrame(runs)
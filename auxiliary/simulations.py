@@ -2,8 +2,11 @@
 
 #Packages
 #Packages
+import warnings
 import pandas as pd
 import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
 import matplotlib.pyplot as plt
 import matplotlib.ticker
 import statsmodels.formula.api as smf
@@ -24,43 +27,139 @@ pd.options.display.float_format = "{:,.2f}".format
 from auxiliary.data_import import *
 from auxiliary.plots import *
 from auxiliary.tables import *
+from auxiliary.spatial_weights import *
+from auxiliary.simulation_store import *
+
+# sparse spatial lag operator
+def spatial_lag_operator(w):
+    """
+    Builds the spatial lag operator of a weight matrix as a sparse CSR matrix
+        The operator is binary (not standardized), i.e. the same as w.full()[0]
+        for the untransformed KNN weights used in the simulations, but only
+        stores the N*k non-zero entries.
+
+    Inputs:
+        - w: libpysal weights object
+
+    Returns: W (scipy.sparse.csr_matrix)
+    """
+    W = w.sparse.tocsr(copy=True)
+    W.data[:] = 1.0 #binary, independent of the current transform of w
+
+    return W
+
+# general equilibrium outcome
+def solve_equilibrium(W, rho, rhs, solver="auto", tol=1e-10, maxiter=1000):
+    """
+    Solves the general equilibrium "Y = rho*WY + rhs", i.e. Y = (I - rho*W)^-1 rhs
+        Several right-hand sides (columns of rhs) are solved together.
+        - "iterative": fixed-point iteration Y = rhs + rho*WY (the loop used
+          before) until the relative residual falls below tol, a few sparse
+          products for the small rho of the simulations
+        - "direct": sparse LU factorization of (I - rho*W), computed once
+          and reused for all right-hand sides (slow for large grids)
+        - "auto": "iterative" if the iteration converges, i.e. |rho| times the
+          largest row sum of W is below one, otherwise "direct"
+
+    Inputs:
+        - W: sparse spatial lag operator (see spatial_lag_operator)
+        - rho: spatial autoregressive parameter
+        - rhs: array of shape (N,) or (N, m)
+        - solver: "auto", "iterative" or "direct"
+        - tol: tolerance for the relative residual (iterative solver)
+        - maxiter: maximum number of iterations (iterative solver)
+
+    Returns: Y (array, same shape as rhs), residual (float, max relative residual)
+    """
+    rhs = np.asarray(rhs, dtype=float)
+    A = sparse.identity(W.shape[0], format="csr") - rho*W
+    norm_rhs = np.maximum(np.linalg.norm(rhs, axis=0), np.finfo(float).tiny)
+
+    if solver == "auto":
+        solver = "iterative" if abs(rho)*abs(W).sum(axis=1).max() < 1 else "direct"
+
+    if solver == "direct":
+        lu = splinalg.splu(A.tocsc()) #factorize once
+        Y = lu.solve(rhs)
+    elif solver == "iterative":
+        Y = rhs.copy()
+        for i in range(maxiter):
+            Y_new = rhs + rho*W.dot(Y)
+            #the update equals the residual of the previous iterate
+            change = np.max(np.linalg.norm(Y_new - Y, axis=0)/norm_rhs)
+            Y = Y_new
+            if change <= tol:
+                break
+    else:
+        raise ValueError(f"unknown solver {solver!r}")
+
+    # report the residual of the linear system
+    residual = float(np.max(np.linalg.norm(A.dot(Y) - rhs, axis=0)/norm_rhs))
+    if solver == "iterative" and residual > tol:
+        warnings.warn(f"Equilibrium did not converge (relative residual {residual:.2e} after {maxiter} iterations)")
+
+    return Y, residual
 
 #get simulation results
-def get_simulation_results():
+def get_simulation_results(store=STORE_PATH):
     """
     For obtaining the results of the simulation study
-        
+        Experiments with complete runs in the simulation store (see
+        simulation_runner.run_simulation_study) are summarized chunk by chunk
+        from the store, the remaining experiments are read from the csv files.
+        Runs without one of the experiment labels of the csv files (Sim1,
+        Sim2, Sim3) are not part of the table.
+
+    Inputs: store (string), directory of the simulation store
+
     Returns: table (DataFrame)
     """
-    SLX_sim = pd.read_csv("data/SLX_sim.csv", index_col=0)
-    SDM_sim = pd.read_csv("data/SDM_sim.csv", index_col=0)
-    backdoor_sim = pd.read_csv("data/backdoor_sim.csv", index_col=0)
-    Spatial_Lag_sim = pd.read_csv("data/Spatial_Lag_sim.csv", index_col=0)
-
-    table = pd.concat([SLX_sim,Spatial_Lag_sim, SDM_sim, backdoor_sim], axis=1)
-    table.columns = pd.MultiIndex.from_product(
-        [['SLX Simulation', 'Spatial Lag','SDM Simulation', 'Backdoor Simulation'],['Simple', 'Small', 'Large']]
-        )
-        
+    designs = {"SLX": ("SLX Simulation", "data/SLX_sim.csv"),
+               "SpatialLag": ("Spatial Lag", "data/Spatial_Lag_sim.csv"),
+               "SDM": ("SDM Simulation", "data/SDM_sim.csv"),
+               "backdoor": ("Backdoor Simulation", "data/backdoor_sim.csv")}
+    labels = {"Sim1": "Simple", "Sim2": "Small", "Sim3": "Large"}
+
+    runs = list_runs(store)
+    if not runs.empty:
+        runs = runs[runs["complete"] & runs["experiment"].isin(list(labels))].sort_values("created")
+
+    tables = {}
+    for design, (name, csv) in designs.items():
+        sim = pd.read_csv(csv, index_col=0)
+        if not runs.empty:
+            #latest complete run per experiment replaces that column of the csv file
+            for experiment, design_runs in runs[runs["design"] == design].groupby("experiment"):
+                sim[experiment] = summarize_run(design_runs["run_dir"].iloc[-1])
+        tables[name] = sim.rename(columns=labels)
+
+    table = pd.concat(tables, axis=1)
+
     return table
 
 # SLX sample
 def simulate_SLX_sample(num_obs,
                         knn = 10,
                         beta = 0.9,
-                        gamma = 0.25):
+                        gamma = 0.25,
+                        stencil = False):
     """Simulate spatial sample with only spillover from treatment variable
         "Y = WD + X"
 
     Args:
         num_obs: An integer that specifies the number of individuals
-            to sample. Needs to be either 100 or 10.000 for the weight matrix.
+            to sample, or a tuple (rows, cols) for the grid.
+        stencil: build the weight matrix from the lattice instead of
+            a KNN tree search (see get_grid_weights).
 
     Returns:
         Returns a dataframe with the observables (Y, X, D) as well as
         the unobservables (Y_1, Y_0) and the weight matrix w.
     """
 
+    rows, cols = grid_shape(num_obs)
+    num_obs = rows*cols
+
     # Initialize empty data frame
     columns = ["Y", "Y_1", "Y_0", "D", "X", "WD"]
     df = pd.DataFrame(columns=columns, index=range(num_obs))
@@ -68,26 +167,12 @@ def simulate_SLX_sample(num_obs,
     df["D"] = np.random.randint(2, size=num_obs) #binary treatment
     df["X"] = np.random.normal(size=num_obs)
     
-    if num_obs == 100:
-            # generate grid for weight matrix
-            x,y=np.indices((10, 10))
-            x.shape=(num_obs,1)
-            y.shape=(num_obs,1)
-            data=np.hstack([x,y])
-    elif num_obs == 10000:
-            # generate grid for weight matrix
-            x,y=np.indices((100, 100))
-            x.shape=(num_obs,1)
-            y.shape=(num_obs,1)
-            data=np.hstack([x,y])
-    else:
-            raise AssertionError # needs to be 100 or 10.000 for constructing weight matrix
-
-    # weight matrix
-    w = lp.weights.KNN(data, k = knn)
+    # weight matrix (neighbors searched once across replications)
+    w = get_grid_weights(rows, cols, knn = knn, stencil = stencil)
+    W = spatial_lag_operator(w) #sparse, built once per sample
     
     # calculate spillovers
-    df["WD"] = np.dot(w.full()[0], df["D"].to_numpy())#not standardized
+    df["WD"] = W.dot(df["D"].to_numpy())#not standardized
     
     # outcomes
     df["Y"] = beta*df["X"] + gamma*df["WD"] + gamma*df["D"] #add D since W is sparse
@@ -101,19 +186,31 @@ def simulate_SDM_sample(num_obs,
                             knn = 10,
                             beta = 0.9,
                             gamma = 0.25,
-                            rho = 0.05):
+                            rho = 0.05,
+                            solver = "auto",
+                            tol = 1e-10,
+                            stencil = False):
     """Simulate spatial sample with spillover from the treatment and the outcome variable
         "Y = WY+ WD + X"
 
     Args:
         num_obs: An integer that specifies the number of individuals
-            to sample.
+            to sample, or a tuple (rows, cols) for the grid.
+        stencil: build the weight matrix from the lattice instead of
+            a KNN tree search (see get_grid_weights).
+        solver: "auto", "iterative" or "direct" solver for the general
+            equilibrium (see solve_equilibrium).
+        tol: tolerance of the iterative solver.
 
     Returns:
         Returns a dataframe with the observables (Y, X, D) as well as
-        the unobservables (Y_1, Y_0)and the weight matrix w.
+        the unobservables (Y_1, Y_0)and the weight matrix w. The residual of
+        the equilibrium solve is stored in df.attrs["residual"].
     """
 
+    rows, cols = grid_shape(num_obs)
+    num_obs = rows*cols
+
     # Initialize empty data frame
     columns = ["Y", "Y_1", "Y_0", "D", "X", "WD"]
     df = pd.DataFrame(columns=columns, index=range(num_obs))
@@ -121,26 +218,12 @@ def simulate_SDM_sample(num_obs,
     df["D"] = np.random.randint(2, size=num_obs) #binary treatment
     df["X"] = np.random.normal(size=num_obs)
     
-    if num_obs == 100:
-            # generate grid for weight matrix
-            x,y=np.indices((10, 10))
-            x.shape=(num_obs,1)
-            y.shape=(num_obs,1)
-            data=np.hstack([x,y])
-    elif num_obs == 2500:
-            # generate grid for weight matrix
-            x,y=np.indices((50, 50))
-            x.shape=(num_obs,1)
-            y.shape=(num_obs,1)
-            data=np.hstack([x,y])
-    else:
-            raise AssertionError # needs to be 100 or 10.000 for constructing weight matrix
-
-    # weight matrix
-    w = lp.weights.KNN(data, k = knn)
+    # weight matrix (neighbors searched once across replications)
+    w = get_grid_weights(rows, cols, knn = knn, stencil = stencil)
+    W = spatial_lag_operator(w) #sparse, built once per sample
     
     # calculate spillovers
-    df["WD"] = np.dot(w.full()[0], df["D"].to_numpy())#not standardized
+    df["WD"] = W.dot(df["D"].to_numpy())#not standardized
     
     # outcomes
     df["Y"] = beta*df["X"] + gamma*df["WD"] + gamma*df["D"] #add D since W is sparse
@@ -151,12 +234,13 @@ def simulate_SDM_sample(num_obs,
     df["Y_1_no_spill"] = df["Y_1"]
     df["Y_0_no_spill"] = df["Y_0"]
     
-    # iterate to generate general equilibrium effect (already settles after 5 times for small rho)
-    for i in range(0,10):
-        df["WY"] = np.dot(w.full()[0], df["Y"].to_numpy())#not standardized
-        df["Y"] = beta*df["X"] +  gamma*df["D"] + rho* df["WY"]   
-        df["Y_1"] = beta*df["X"] + gamma + rho* df["WY"]   
-        df["Y_0"] = beta*df["X"] + rho* df["WY"]   
+    # solve for the general equilibrium effect
+    rhs = (beta*df["X"] + gamma*df["D"]).to_numpy()
+    Y, df.attrs["residual"] = solve_equilibrium(W, rho, rhs, solver=solver, tol=tol)
+    df["WY"] = W.dot(Y)#not standardized
+    df["Y"] = beta*df["X"] +  gamma*df["D"] + rho* df["WY"]
+    df["Y_1"] = beta*df["X"] + gamma + rho* df["WY"]
+    df["Y_0"] = beta*df["X"] + rho* df["WY"]
     
     return df, w
 
@@ -165,19 +249,31 @@ def simulate_backdoor_sample(num_obs,
                             knn = 10,
                             beta = 0.9,
                             gamma = 0.25,
-                            rho = 0.05):
+                            rho = 0.05,
+                            solver = "auto",
+                            tol = 1e-10,
+                            stencil = False):
     """Simulate spatial sample with spillover from treatment and outcome variable
         "Y = WY+ WD + X" and "D = WD"
 
     Args:
         num_obs: An integer that specifies the number of individuals
-            to sample.
+            to sample, or a tuple (rows, cols) for the grid.
+        stencil: build the weight matrix from the lattice instead of
+            a KNN tree search (see get_grid_weights).
+        solver: "auto", "iterative" or "direct" solver for the general
+            equilibrium (see solve_equilibrium).
+        tol: tolerance of the iterative solver.
 
     Returns:
         Returns a dataframe with the observables (Y, X, D) as well as
-        the unobservables (Y_1, Y_0) and the weight matrix w.
+        the unobservables (Y_1, Y_0) and the weight matrix w. The residual of
+        the equilibrium solve is stored in df.attrs["residual"].
     """
 
+    rows, cols = grid_shape(num_obs)
+    num_obs = rows*cols
+
     # Initialize empty data frame
     columns = ["Y", "Y_1", "Y_0", "D", "X", "WD"]
     df = pd.DataFrame(columns=columns, index=range(num_obs))
@@ -185,26 +281,12 @@ def simulate_backdoor_sample(num_obs,
     df["D"] = np.random.randint(2, size=num_obs) #binary treatment
     df["X"] = np.random.normal(size=num_obs)
     
-    if num_obs == 100:
-            # generate grid for weight matrix
-            x,y=np.indices((10, 10))
-            x.shape=(num_obs,1)
-            y.shape=(num_obs,1)
-            data=np.hstack([x,y])
-    elif num_obs == 2500:
-            # generate grid for weight matrix
-            x,y=np.indices((50, 50))
-            x.shape=(num_obs,1)
-            y.shape=(num_obs,1)
-            data=np.hstack([x,y])
-    else:
-            raise AssertionError # needs to be 100 or 10.000 for constructing weight matrix
-
-    # weight matrix
-    w = lp.weights.KNN(data, k = knn)
+    # weight matrix (neighbors searched once across replications)
+    w = get_grid_weights(rows, cols, knn = knn, stencil = stencil)
+    W = spatial_lag_operator(w) #sparse, built once per sample
     
     # calculate spillovers
-    df["WD"] = np.dot(w.full()[0], df["D"].to_numpy())/knn #standardized
+    df["WD"] = W.dot(df["D"].to_numpy())/knn #standardized
 
     # whether you are treated is function of other's treatment
     df.loc[(df.WD > 0.5), 'D']=1
@@ -219,12 +301,13 @@ def simulate_backdoor_sample(num_obs,
     df["Y_1_no_spill"] = df["Y_1"]
     df["Y_0_no_spill"] = df["Y_0"]
     
-    # iterate to generate general equilibrium effect (already settles after 5 times for small rho)
-    for i in range(0,10):
-        df["WY"] = np.dot(w.full()[0], df["Y"].to_numpy())#not standardized
-        df["Y"] = beta*df["X"] + gamma*df["WD"] + gamma*df["D"] + rho* df["WY"]   
-        df["Y_1"] = beta*df["X"] + gamma*df["WD"] + gamma + rho* df["WY"]   
-        df["Y_0"] = beta*df["X"] + gamma*df["WD"] + rho* df["WY"]   
+    # solve for the general equilibrium effect
+    rhs = (beta*df["X"] + gamma*df["WD"] + gamma*df["D"]).to_numpy()
+    Y, df.attrs["residual"] = solve_equilibrium(W, rho, rhs, solver=solver, tol=tol)
+    df["WY"] = W.dot(Y)#not standardized
+    df["Y"] = beta*df["X"] + gamma*df["WD"] + gamma*df["D"] + rho* df["WY"]
+    df["Y_1"] = beta*df["X"] + gamma*df["WD"] + gamma + rho* df["WY"]
+    df["Y_0"] = beta*df["X"] + gamma*df["WD"] + rho* df["WY"]
     
     return df, w
 
@@ -233,19 +316,31 @@ def simulate_SpatialLag_sample(num_obs,
                             knn = 10,
                             beta = 0.9,
                             gamma = 0.25,
-                            rho = 0.05):
+                            rho = 0.05,
+                            solver = "auto",
+                            tol = 1e-10,
+                            stencil = False):
     """Simulate spatial sample with spillover from the treatment and the outcome variable
         "Y = WY+ WD + X"
 
     Args:
         num_obs: An integer that specifies the number of individuals
-            to sample.
+            to sample, or a tuple (rows, cols) for the grid.
+        stencil: build the weight matrix from the lattice instead of
+            a KNN tree search (see get_grid_weights).
+        solver: "auto", "iterative" or "direct" solver for the general
+            equilibrium (see solve_equilibrium).
+        tol: tolerance of the iterative solver.
 
     Returns:
         Returns a dataframe with the observables (Y, X, D) as well as
-        the unobservables (Y_1, Y_0)and the weight matrix w.
+        the unobservables (Y_1, Y_0)and the weight matrix w. The residual of
+        the equilibrium solve is stored in df.attrs["residual"].
     """
 
+    rows, cols = grid_shape(num_obs)
+    num_obs = rows*cols
+
     # Initialize empty data frame
     columns = ["Y", "Y_1", "Y_0", "D", "X", "WD"]
     df = pd.DataFrame(columns=columns, index=range(num_obs))
@@ -253,23 +348,9 @@ def simulate_SpatialLag_sample(num_obs,
     df["D"] = np.random.randint(2, size=num_obs) #binary treatment
     df["X"] = np.random.normal(size=num_obs)
     
-    if num_obs == 100:
-            # generate grid for weight matrix
-            x,y=np.indices((10, 10))
-            x.shape=(num_obs,1)
-            y.shape=(num_obs,1)
-            data=np.hstack([x,y])
-    elif num_obs == 2500:
-            # generate grid for weight matrix
-            x,y=np.indices((50, 50))
-            x.shape=(num_obs,1)
-            y.shape=(num_obs,1)
-            data=np.hstack([x,y])
-    else:
-            raise AssertionError # needs to be 100 or 10.000 for constructing weight matrix
-
-    # weight matrix
-    w = lp.weights.KNN(data, k = knn)
+    # weight matrix (neighbors searched once across replications)
+    w = get_grid_weights(rows, cols, knn = knn, stencil = stencil)
+    W = spatial_lag_operator(w) #sparse, built once per sample
     
    
     # outcomes
@@ -281,11 +362,100 @@ def simulate_SpatialLag_sample(num_obs,
     df["Y_1_no_spill"] = df["Y_1"]
     df["Y_0_no_spill"] = df["Y_0"]
     
-    # iterate to generate general equilibrium effect (already settles after 5 times for small rho)
-    for i in range(0,10):
-        df["WY"] = np.dot(w.full()[0], df["Y"].to_numpy())#not standardized
-        df["Y"] = beta*df["X"] + gamma*df["D"] + rho* df["WY"]   
-        df["Y_1"] = beta*df["X"] + gamma + rho* df["WY"]   
-        df["Y_0"] = beta*df["X"] + rho* df["WY"]   
+    # solve for the general equilibrium effect
+    rhs = (beta*df["X"] + gamma*df["D"]).to_numpy()
+    Y, df.attrs["residual"] = solve_equilibrium(W, rho, rhs, solver=solver, tol=tol)
+    df["WY"] = W.dot(Y)#not standardized
+    df["Y"] = beta*df["X"] + gamma*df["D"] + rho* df["WY"]
+    df["Y_1"] = beta*df["X"] + gamma + rho* df["WY"]
+    df["Y_0"] = beta*df["X"] + rho* df["WY"]
     
     return df, w
+
+# batched samples
+def simulate_batch(design,
+                    num_obs,
+                    n_reps,
+                    knn = 10,
+                    beta = 0.9,
+                    gamma = 0.25,
+                    rho = 0.05,
+                    solver = "auto",
+                    tol = 1e-10,
+                    seed = None,
+                    stencil = False):
+    """Simulate n_reps samples of one design at once, sharing the weight matrix
+        Each variable is an (N, n_reps) array with one replication per column,
+        so that the spatial lags and the general equilibrium are computed with
+        a few sparse-dense products instead of one call per replication.
+        The outcomes follow the same equations as the simulate_*_sample functions.
+
+    Args:
+        design: One of "SLX", "SpatialLag", "SDM" or "backdoor".
+        num_obs: An integer that specifies the number of individuals
+            to sample, or a tuple (rows, cols) for the grid.
+        stencil: build the weight matrix from the lattice instead of
+            a KNN tree search (see get_grid_weights).
+        n_reps: Number of replications (columns).
+        solver: "auto", "iterative" or "direct" solver for the general
+            equilibrium (see solve_equilibrium).
+        tol: tolerance of the iterative solver.
+        seed: seed (or numpy SeedSequence) of the random generator.
+
+    Returns:
+        Returns a dictionary with the observables (Y, X, D, WD) and the
+        unobservables (Y_1, Y_0), for the spillover designs also WY, the
+        outcomes without spillover and the residual of the equilibrium
+        solve, as well as the weight matrix w.
+    """
+    if design not in ("SLX", "SpatialLag", "SDM", "backdoor"):
+        raise ValueError(f"Unknown design {design}")
+
+    rows, cols = grid_shape(num_obs)
+    num_obs = rows*cols
+    rng = np.random.default_rng(seed)
+
+    sample = {}
+    sample["D"] = rng.integers(2, size=(num_obs, n_reps)).astype(float) #binary treatment
+    sample["X"] = rng.normal(size=(num_obs, n_reps))
+
+    # weight matrix (neighbors searched once across replications)
+    w = get_grid_weights(rows, cols, knn = knn, stencil = stencil)
+    W = spatial_lag_operator(w)
+
+    # calculate spillovers
+    X = sample["X"]
+    WD = W.dot(sample["D"])#not standardized
+    if design == "backdoor":
+        # whether you are treated is function of other's treatment
+        WD = WD/knn #standardized
+        sample["D"] = (WD > 0.5).astype(float)
+    D = sample["D"]
+    sample["WD"] = WD
+
+    # outcomes
+    if design == "SLX":
+        sample["Y"] = beta*X + gamma*WD + gamma*D
+        sample["Y_1"] = beta*X + gamma*WD + gamma
+        sample["Y_0"] = beta*X + gamma*WD
+        return sample, w
+    elif design in ("SDM", "backdoor"):
+        sample["Y_no_spill"] = beta*X + gamma*WD + gamma*D
+        sample["Y_1_no_spill"] = beta*X + gamma*WD + gamma
+        sample["Y_0_no_spill"] = beta*X + gamma*WD
+    else: #spatial lag
+        sample["Y_no_spill"] = beta*X + gamma*D
+        sample["Y_1_no_spill"] = beta*X + gamma
+        sample["Y_0_no_spill"] = beta*X
+
+    # the treatment spillover only enters the equilibrium in the backdoor design
+    base = beta*X + gamma*WD if design == "backdoor" else beta*X
+
+    # solve for the general equilibrium effect of all replications together
+    Y, sample["residual"] = solve_equilibrium(W, rho, base + gamma*D, solver=solver, tol=tol)
+    sample["WY"] = W.dot(Y)#not standardized
+    sample["Y"] = base + gamma*D + rho*sample["WY"]
+    sample["Y_1"] = base + gamma + rho*sample["WY"]
+    sample["Y_0"] = base + rho*sample["WY"]
+
+    return sample, w
@@ -0,0 +1,239 @@
+"""This module contains auxiliary functions for testing spatial dependence, which are used in the main notebook."""
+
+#Packages
+from collections import namedtuple
+
+import pandas as pd
+import numpy as np
+from scipy import linalg, stats
+
+from auxiliary.parallel import spawn_batches, thread_map
+from auxiliary.spatial_weights import transform_matrix
+
+
+LocalMoran = namedtuple("LocalMoran", ["Is", "p_sim", "q"])
+
+LM_TESTS = ["LM lag", "Robust LM lag", "LM error", "Robust LM error", "LM SARMA"]
+
+def _weights_matrix(w, transformation="r"):
+    """
+    Sparse matrix of a libpysal weights object, row-standardized for transformation "r"
+        The weights object itself is not modified.
+    """
+    return transform_matrix(w.sparse, "R" if transformation.lower() == "r" else "O")
+
+def _folded_pvalue(larger, permutations):
+    """
+    Pseudo p-value of a permutation test as in esda, (min(larger, perms - larger) + 1)/(perms + 1)
+    """
+    larger = np.minimum(larger, permutations - larger)
+    return (larger + 1.0)/(permutations + 1.0)
+
+# global Moran's I
+def moran_batch(data, variables, w, transformation="r", permutations=999, seed=None,
+                workers=1, batch_size=100):
+    """
+    Global Moran's I of several variables with shared permutations
+        All variables are demeaned as one matrix (N, m). Every permutation of the
+        observations is applied to all variables at once, so a batch of B
+        permutations needs a single sparse product W @ Z of shape (N, B*m).
+        Batches draw from their own spawned seed and can run on a thread pool;
+        the result does not depend on the number of workers.
+        The statistics equal esda.moran.Moran(data[variable], w) for every variable.
+
+    Inputs:
+        - data: data frame
+        - variables: list of column names
+        - w: libpysal weights object (same order as data)
+        - transformation: "r" (row-standardized) or "o" (weights as they are)
+        - permutations: number of random permutations (0: no inference)
+        - seed: seed (integer or SeedSequence)
+        - workers: number of threads
+        - batch_size: permutations per sparse product
+
+    Returns: results (DataFrame with one row per variable: I, EI, EI_sim, seI_sim, z_sim, p_sim)
+    """
+    W = _weights_matrix(w, transformation)
+    Y = data[variables].to_numpy(dtype=float)
+    nobs, m = Y.shape
+
+    Z = Y - Y.mean(axis=0)
+    scale = nobs/W.sum()/np.sum(Z**2, axis=0)
+    I = scale*np.sum(Z*W.dot(Z), axis=0)
+
+    results = pd.DataFrame({"I": I, "EI": -1.0/(nobs - 1)}, index=pd.Index(variables, name="Variable"))
+    if not permutations:
+        return results
+
+    def simulate(args):
+        size, batch_seed = args
+        rng = np.random.default_rng(batch_seed)
+        order = np.argsort(rng.random((nobs, size)), axis=0) #one permutation per column
+        Zp = Z[order].reshape(nobs, size*m) #permuted variables (N, B*m)
+        sim = np.sum(Zp*W.dot(Zp), axis=0).reshape(size, m)
+        return scale*sim
+
+    sim = np.vstack(thread_map(simulate, spawn_batches(permutations, batch_size, seed), workers))
+
+    results["EI_sim"] = sim.mean(axis=0)
+    results["seI_sim"] = sim.std(axis=0)
+    results["z_sim"] = (I - results["EI_sim"])/results["seI_sim"]
+    results["p_sim"] = _folded_pvalue(np.sum(sim >= I, axis=0), permutations)
+
+    return results
+
+# local Moran's I
+def local_moran_batch(data, variables, w, transformation="r", permutations=999, seed=None,
+                      workers=1, batch_size=100):
+    """
+    Local Moran's I of several variables with shared conditional permutations
+        Inference uses conditional randomization as esda.moran.Moran_Local: for
+        every observation the values of its neighbors are replaced by a random
+        draw from all other observations. A batch draws one set of index arrays
+        (B, max number of neighbors), which is shifted around every observation
+        and reused for all variables. Batches draw from their own spawned seed and
+        can run on a thread pool; the result does not depend on the number of workers.
+
+    Inputs: see moran_batch
+
+    Returns: LocalMoran with the data frames (N, m)
+        - Is: local statistics
+        - p_sim: pseudo p-values (zeros if permutations=0)
+        - q: quadrant of the Moran scatterplot (1 HH, 2 LH, 3 LL, 4 HL)
+    """
+    W = _weights_matrix(w, transformation)
+    Y = data[variables].to_numpy(dtype=float)
+    nobs, m = Y.shape
+
+    # neighbors and their weights padded to the largest number of neighbors (N, max_card)
+    cards = np.diff(W.indptr)
+    max_card = max(cards.max(), 1)
+    filled = np.arange(max_card) < cards[:, np.newaxis]
+    neighbors = np.zeros((nobs, max_card), dtype=int)
+    neighbors[filled] = W.indices
+    weights = np.zeros((nobs, max_card))
+    weights[filled] = W.data
+
+    def local_lag(z, ids):
+        """
+        Weighted sum of z[ids] per observation (N, B)
+        """
+        return np.einsum("nbk,nk->nb", z[ids], weights)
+
+    # the lag is summed in the same way as in the permutations, so that ties
+    # (e.g. neighbors with identical values) compare as equal
+    Z = (Y - Y.mean(axis=0))/Y.std(axis=0)
+    lag = np.column_stack([local_lag(z, neighbors[:, np.newaxis, :])[:, 0] for z in Z.T])
+    scale = (nobs - 1)/np.sum(Z**2, axis=0)
+    Is = scale*Z*lag
+
+    q = np.where(Z > 0, np.where(lag > 0, 1, 4), np.where(lag > 0, 2, 3))
+
+    frame = lambda values: pd.DataFrame(values, index=data.index, columns=variables)
+    if not permutations:
+        return LocalMoran(frame(Is), frame(np.zeros_like(Is)), frame(q))
+
+    own = np.arange(nobs)[:, np.newaxis, np.newaxis]
+
+    def exceed(args):
+        size, batch_seed = args
+        rng = np.random.default_rng(batch_seed)
+        # random draws without replacement from N - 1 other observations
+        keys = rng.random((size, nobs - 1))
+        ids = np.argpartition(keys, max_card - 1, axis=1)[:, :max_card]
+        ids = np.take_along_axis(ids, np.argsort(np.take_along_axis(keys, ids, axis=1), axis=1), axis=1)
+        ids = ids + (ids >= own) #skip the observation itself (N, B, max_card)
+
+        counts = np.empty((nobs, m))
+        for j in range(m):
+            lag_sim = local_lag(Z[:, j], ids)
+            counts[:, j] = np.sum(scale[j]*Z[:, j, np.newaxis]*lag_sim >= Is[:, j, np.newaxis], axis=1)
+        return counts
+
+    counts = np.sum(thread_map(exceed, spawn_batches(permutations, batch_size, seed), workers), axis=0)
+
+    return LocalMoran(frame(Is), frame(_folded_pvalue(counts, permutations)), frame(q))
+
+# Lagrange multiplier tests
+def spatial_trace(w):
+    """
+    Trace term T = tr(W'W + WW) of the LM tests
+        Computed from the nonzero entries of the sparse matrix, as the sum of
+        W*W + W*W' (elementwise), in time linear in the number of neighbors.
+
+    Returns: T (float)
+    """
+    W = w.sparse.tocsr()
+    return W.multiply(W).sum() + W.multiply(W.T).sum()
+
+def lm_tests(y, X, w, add_constant=True, trace=None):
+    """
+    Lagrange multiplier tests for spatial dependence in the residuals of an OLS fit
+        LM lag, LM error, their robust versions and the joint SARMA test as in
+        Anselin et al. (1996), like spreg.OLS(..., spat_diag=True). Only sparse
+        products with W and the trace term are needed.
+
+    Inputs:
+        - y: outcome (N,)
+        - X: regressors (N, k)
+        - w: libpysal weights object (transform as it should be used, usually "R")
+        - add_constant: whether to add an intercept
+        - trace: trace term of w (see spatial_trace), computed if not given
+
+    Returns: results (DataFrame with one row per test: statistic, df, p-value)
+    """
+    W = w.sparse.tocsr()
+    y = np.asarray(y, dtype=float).ravel()
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    if add_constant:
+        X = np.column_stack([np.ones(len(y)), X])
+    nobs = len(y)
+
+    Q, _ = linalg.qr(X, mode="economic")
+    residual = lambda v: v - Q.dot(Q.T.dot(v)) #M v
+
+    u = residual(y)
+    sigma2 = u.dot(u)/nobs
+    if trace is None:
+        trace = spatial_trace(w)
+
+    Wu = W.dot(u)
+    lag_score = u.dot(W.dot(y))/sigma2 #u'Wy/s2
+    error_score = u.dot(Wu)/sigma2 #u'Wu/s2
+    wxb = W.dot(y - u) #W X b
+    nj = residual(wxb).dot(wxb)/sigma2 + trace
+
+    statistics = [lag_score**2/nj,
+                  (lag_score - error_score)**2/(nj - trace),
+                  error_score**2/trace,
+                  (error_score - trace/nj*lag_score)**2/(trace*(1 - trace/nj)),
+                  (lag_score - error_score)**2/(nj - trace) + error_score**2/trace]
+    df = np.array([1, 1, 1, 1, 2])
+
+    results = pd.DataFrame({"statistic": statistics, "df": df, "p-value": stats.chi2.sf(statistics, df)},
+                           index=pd.Index(LM_TESTS, name="Test"))
+    return results
+
+def lm_tests_batch(data, y, specification, weights):
+    """
+    LM tests for several specifications and weights objects
+        The trace term is computed once per weights object.
+
+    Inputs:
+        - data: data frame (same order as the weights)
+        - y: column name of the outcome
+        - specification: dictionary with lists of regressors
+        - weights: dictionary with libpysal weights objects (e.g. {8: w_knn8, ...})
+
+    Returns: results (DataFrame with index (specification, weights, test))
+    """
+    traces = {label: spatial_trace(w) for label, w in weights.items()}
+
+    results = {}
+    for name, regressors in specification.items():
+        for label, w in weights.items():
+            results[(name, label)] = lm_tests(data[y], data[regressors], w, trace=traces[label])
+
+    return pd.concat(results, names=["Specification", "Weights"])
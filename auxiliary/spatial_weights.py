@@ -0,0 +1,571 @@
+"""This module contains auxiliary functions for constructing spatial weight matrices, which are used in the simulations and the main notebook."""
+
+#Packages
+import hashlib
+
+import pandas as pd
+import numpy as np
+from scipy import sparse, spatial
+
+#For spatial analysis
+import libpysal as lp
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+from auxiliary.result_cache import LRUCache
+
+
+# maximum number of grid neighbor matrices kept in the cache
+WEIGHTS_CACHE_SIZE = 8
+
+_weights_cache = LRUCache(WEIGHTS_CACHE_SIZE)
+
+# number of neighbors queried for distance bands (and number of cached queries)
+K_MAX = 20
+NEIGHBOR_CACHE_SIZE = 8
+
+_neighbor_cache = LRUCache(NEIGHBOR_CACHE_SIZE)
+
+# grid shape
+def grid_shape(num_obs):
+    """
+    Finds the rectangular grid on which a simulation sample lives
+        A tuple (rows, cols) is returned as is. For an integer the most
+        square factorization is used, e.g. 2500 -> (50, 50), 200 -> (10, 20).
+        An integer without a factorization into more than one row (a prime)
+        raises an error, since a 1 x N strip is not the lattice the designs
+        assume; such a strip has to be passed as a tuple (1, N).
+
+    Inputs:
+        - num_obs: integer (number of observations) or tuple (rows, cols)
+
+    Returns: rows (int), cols (int)
+    """
+    if isinstance(num_obs, tuple):
+        rows, cols = num_obs
+    else:
+        rows = int(np.sqrt(num_obs))
+        while rows > 1 and num_obs % rows != 0:
+            rows -= 1
+        cols = num_obs // max(rows, 1)
+        if rows == 1 and num_obs > 1:
+            raise ValueError(f"num_obs={num_obs} has no factorization into a grid with more than one row, "
+                             "pass the grid shape (rows, cols) instead")
+
+    if rows < 1 or cols < 1 or int(rows) != rows or int(cols) != cols:
+        raise ValueError(f"Cannot construct a grid for num_obs={num_obs}")
+
+    return int(rows), int(cols)
+
+# grid coordinates
+def grid_coordinates(rows, cols):
+    """
+    Generates the (row, col) coordinates of all cells of a grid
+
+    Returns: data (array of shape (rows*cols, 2))
+    """
+    x,y=np.indices((rows, cols))
+    x.shape=(rows*cols,1)
+    y.shape=(rows*cols,1)
+    data=np.hstack([x,y])
+
+    return data
+
+# weights of a lattice from index arithmetic
+def lattice_offsets(rows, cols, kind="rook", k=10):
+    """
+    Offsets (row, col) of the neighbors of a cell on a lattice
+        For "rook" and "queen" the fixed stencils. For "knn" all offsets
+        within the smallest radius that contains k cells of the grid seen
+        from a corner (the cell with the fewest cells nearby), so that the
+        k nearest neighbors of every cell are among them. The offsets are
+        ordered by distance and ties by row and column offset, i.e. equally
+        distant neighbors are taken in the order of the cells.
+
+    Returns: offsets (array of shape (m, 2))
+    """
+    if kind == "rook":
+        return np.array([(-1, 0), (0, -1), (0, 1), (1, 0)])
+    if kind == "queen":
+        return np.array([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)])
+    if kind != "knn":
+        raise ValueError(f"Unknown kind {kind}")
+
+    k = min(k, rows*cols - 1)
+    reach = int(np.ceil(np.sqrt(k))) + 1
+    while True:
+        a, b = np.indices((2*reach + 1, 2*reach + 1)) - reach
+        offsets = np.column_stack([a.ravel(), b.ravel()])
+        distances = np.sum(offsets**2, axis=1)
+        order = np.lexsort((offsets[:, 1], offsets[:, 0], distances))
+        offsets, distances = offsets[order][1:], distances[order][1:] #without the cell itself
+
+        # cells of the grid seen from the corner, by distance
+        corner = (offsets[:, 0] >= 0) & (offsets[:, 0] < rows) & (offsets[:, 1] >= 0) & (offsets[:, 1] < cols)
+        if corner.sum() >= k:
+            radius = distances[corner][k - 1]
+            if radius <= reach**2:
+                return offsets[distances <= radius]
+        reach *= 2
+
+def lattice_matrix(rows, cols, kind="rook", k=10):
+    """
+    Sparse binary weight matrix of a lattice, built from index arithmetic
+        The neighbors of cell i = row*cols + col are i + dr*cols + dc for the
+        offsets of lattice_offsets. Cells further than the stencil from the
+        border all have the same neighbors, only the cells at the border are
+        checked for offsets outside the grid (and for "knn" take the next
+        offsets instead). Without a tree search the cost is linear in the
+        number of cells. For "knn" the result equals knn_weights on the grid
+        coordinates, ties among equally distant cells included.
+
+    Inputs:
+        - rows, cols: shape of the grid
+        - kind: "rook" (4 neighbors), "queen" (8 neighbors) or "knn"
+        - k: number of nearest neighbors (only for "knn")
+
+    Returns: W (scipy.sparse.csr_matrix of shape (rows*cols, rows*cols))
+    """
+    nobs = rows*cols
+    offsets = lattice_offsets(rows, cols, kind, k)
+    limit = min(k, nobs - 1) if kind == "knn" else len(offsets)
+    shift = offsets[:, 0]*cols + offsets[:, 1]
+    reach = np.abs(offsets).max(axis=0)
+
+    row, col = np.divmod(np.arange(nobs), cols)
+    border = ((row < reach[0]) | (row >= rows - reach[0]) | (col < reach[1]) | (col >= cols - reach[1]))
+
+    # neighbors per cell, nobs marks an empty slot (N, limit)
+    neighbors = np.arange(nobs)[:, np.newaxis] + shift[:limit]
+
+    cells = np.flatnonzero(border)
+    r = row[cells, np.newaxis] + offsets[:, 0]
+    c = col[cells, np.newaxis] + offsets[:, 1]
+    valid = (r >= 0) & (r < rows) & (c >= 0) & (c < cols)
+    valid &= np.cumsum(valid, axis=1) <= limit
+    candidates = np.where(valid, r*cols + c, nobs)
+    neighbors[cells] = np.sort(candidates, axis=1)[:, :limit]
+
+    neighbors.sort(axis=1)
+    filled = neighbors < nobs
+    indptr = np.concatenate([[0], np.cumsum(filled.sum(axis=1))])
+    indices = neighbors[filled]
+
+    return sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(nobs, nobs))
+
+def lattice_weights(rows, cols, kind="rook", k=10, transform="O"):
+    """
+    Weights object of a lattice (see lattice_matrix)
+        Equals lp.weights.lat2W(rows, cols, rook=...) for "rook" and "queen",
+        and lp.weights.KNN(grid_coordinates(rows, cols), k=k) for "knn" up to
+        the choice among equally distant neighbors.
+
+    Returns: w (libpysal weights object)
+    """
+    return weights_from_sparse(lattice_matrix(rows, cols, kind, k), transform=transform)
+
+def transform_matrix(W, transform="O"):
+    """
+    Applies a libpysal transformation to a sparse matrix
+        "O" as it is, "B" binary, "R" row-standardized (islands keep a row of
+        zeros), as w.transform = ... does for the weights of a W.
+
+    Returns: W (scipy.sparse.csr_matrix, a new matrix)
+    """
+    W = sparse.csr_matrix(W, dtype=float, copy=True)
+    transform = transform.upper()
+    if transform == "B":
+        W.data[:] = 1.0
+    elif transform == "R":
+        row_sums = np.asarray(W.sum(axis=1)).ravel()
+        row_sums[row_sums == 0] = 1 #islands keep a row of zeros
+        W = sparse.diags(1/row_sums).dot(W).tocsr()
+    elif transform != "O":
+        raise ValueError(f"Unknown transform {transform}")
+    return W
+
+class SparseW(lp.weights.W):
+    """
+    libpysal W backed by a sparse matrix
+        w.sparse, w.n and w.transform work on the matrix directly: setting
+        w.transform ("O", "B", "R") transforms the original matrix, as for a W,
+        in linear time. The neighbor dictionaries (w.neighbors, w.weights), which
+        need a Python loop over all cells (seconds for a 1000 x 1000 grid), are
+        only built when they are used, e.g. by w.cardinalities.
+    """
+    def __init__(self, W, ids=None, transform="O"):
+        W = sparse.csr_matrix(W, dtype=float, copy=True)
+        W.sort_indices()
+        self._original = W
+        self._n = W.shape[0]
+        self._id_order = list(range(W.shape[0])) if ids is None else list(ids)
+        self._id_order_set = ids is not None
+        self.silence_warnings = True
+        self.transformations = {}
+        self.transform = transform
+
+    @property
+    def sparse(self):
+        return self._sparse
+
+    @property
+    def n(self):
+        return self._n
+
+    def get_transform(self):
+        return self._transform
+
+    def set_transform(self, value="B"):
+        value = value.upper()
+        self._sparse = transform_matrix(self._original, value)
+        self._transform = value
+        self._reset()
+
+    transform = property(get_transform, set_transform)
+
+    @property
+    def neighbors(self):
+        if "neighbors" not in self._cache:
+            W, ids = self._original, self._id_order
+            self._cache["neighbors"] = {id_: [ids[j] for j in W.indices[W.indptr[i]:W.indptr[i + 1]]]
+                                        for i, id_ in enumerate(ids)}
+        return self._cache["neighbors"]
+
+    @property
+    def weights(self):
+        if "weights" not in self._cache:
+            W = self._sparse
+            self._cache["weights"] = {id_: W.data[W.indptr[i]:W.indptr[i + 1]].tolist()
+                                      for i, id_ in enumerate(self._id_order)}
+        return self._cache["weights"]
+
+def sparse_weights(W, transform="O"):
+    """
+    Weights object of a sparse matrix, without building the neighbor dictionaries (see SparseW)
+
+    Returns: w (SparseW, a libpysal W)
+    """
+    return SparseW(W, transform=transform)
+
+# cached KNN weights on a grid
+def get_grid_weights(rows, cols, knn=10, transform="O", stencil=False):
+    """
+    Returns the KNN weight matrix of a grid, with the neighbors searched once across calls
+        The binary neighbor matrix is kept (read-only) in a process-level cache
+        keyed by (rows, cols, knn, stencil) with least-recently-used eviction, so
+        that the neighbors are only searched once for all Monte Carlo
+        replications. Every call returns a new weights object built from it
+        (see SparseW), which the caller may transform or modify.
+
+    Inputs:
+        - rows, cols: shape of the grid
+        - knn: number of nearest neighbors
+        - transform: libpysal transformation ("O" original, "R" row-standardized...)
+        - stencil: build the neighbors from the lattice (lattice_matrix)
+          instead of a tree search with lp.weights.KNN, ties are then
+          resolved in the order of the cells
+
+    Returns: w (SparseW, a libpysal W)
+    """
+    key = (rows, cols, knn, stencil)
+
+    if key in _weights_cache:
+        W = _weights_cache.lookup(key)
+    else:
+        if stencil:
+            W = lattice_matrix(rows, cols, kind="knn", k=knn)
+        else:
+            W = lp.weights.KNN(grid_coordinates(rows, cols), k = knn).sparse.tocsr()
+        W.data.setflags(write=False)
+        _weights_cache.store(key, W)
+
+    return SparseW(W, transform=transform)
+
+def clear_weights_cache():
+    """
+    Empties the cache of get_grid_weights
+    """
+    _weights_cache.clear()
+
+# nearest neighbor queries shared across k
+def get_coordinates(data):
+    """
+    Coordinates of the observations
+        For a GeoDataFrame the points (or polygon centroids) of the geometry, as
+        used by libpysal's from_dataframe, otherwise the array itself.
+
+    Returns: coordinates (array of shape (N, 2))
+    """
+    if hasattr(data, "geometry"):
+        geometry = data.geometry
+        if not (geometry.geom_type == "Point").all():
+            geometry = geometry.centroid
+        return np.column_stack([geometry.x, geometry.y])
+    return np.asarray(data, dtype=float)
+
+def neighbor_query(coordinates, k=K_MAX):
+    """
+    KD-tree of the coordinates and their k nearest neighbors (without the point itself)
+        The query is the one of lp.weights.KNN: the k + 1 nearest points, without
+        the point itself, or without the last one if the point is not among them
+        (more than k observations at the same location). Equally distant
+        neighbors are thus chosen as by libpysal. Tree and query are cached by a
+        hash of the coordinates and k, so that weights are only searched once.
+
+    Inputs:
+        - coordinates: array of shape (N, 2)
+        - k: number of neighbors to query
+
+    Returns: tree (scipy cKDTree), distances (N, k), indices (N, k)
+    """
+    coordinates = np.ascontiguousarray(coordinates, dtype=float)
+    k = min(k, len(coordinates) - 1)
+    key = (hashlib.sha256(coordinates.tobytes() + str(coordinates.shape).encode()).hexdigest(), k)
+
+    if key in _neighbor_cache:
+        return _neighbor_cache.lookup(key)
+
+    tree = spatial.cKDTree(coordinates, leafsize=10) #as libpysal's KDTree, the leaves decide the order of ties
+    distances, indices = tree.query(coordinates, k=k + 1)
+
+    not_self = indices != np.arange(len(coordinates))[:, np.newaxis]
+    not_self[not_self.all(axis=1), -1] = False
+    distances = distances[not_self].reshape(-1, k)
+    indices = indices[not_self].reshape(-1, k)
+
+    return _neighbor_cache.store(key, (tree, distances, indices))
+
+def weights_from_sparse(W, ids=None, transform="R"):
+    """
+    Converts a sparse matrix into a libpysal weights object
+
+    Inputs:
+        - W: sparse matrix (N, N)
+        - ids: ids of the observations (default: 0, ..., N-1)
+        - transform: libpysal transformation ("O" original, "R" row-standardized...)
+
+    Returns: w (libpysal weights object)
+    """
+    W = sparse.csr_matrix(W)
+    W.sort_indices()
+    ids = list(range(W.shape[0])) if ids is None else list(ids)
+
+    neighbors, weights = {}, {}
+    for i, id_ in enumerate(ids):
+        row = slice(W.indptr[i], W.indptr[i + 1])
+        neighbors[id_] = [ids[j] for j in W.indices[row]]
+        weights[id_] = W.data[row].tolist()
+
+    w = lp.weights.W(neighbors, weights, id_order=ids, silence_warnings=True)
+    if w.transform != transform.upper():
+        w.transform = transform.upper()
+
+    return w
+
+def knn_weights(data, k=8, transform="R"):
+    """
+    K nearest neighbor weights from the cached neighbor query
+        Equals lp.weights.KNN.from_dataframe(data, k=k) (with the given transform),
+        including the choice among equally distant neighbors (see neighbor_query).
+        Repeated calls for the same data and k reuse the query.
+
+    Inputs:
+        - data: GeoDataFrame or array of coordinates (N, 2)
+        - k: number of nearest neighbors
+        - transform: libpysal transformation
+
+    Returns: w (libpysal weights object, ids from the index of data)
+    """
+    _, _, indices = neighbor_query(get_coordinates(data), k=k)
+    k = indices.shape[1]
+    nobs = len(indices)
+
+    W = sparse.csr_matrix((np.ones(nobs*k), indices[:, :k].ravel(), np.arange(0, nobs*k + 1, k)),
+                          shape=(nobs, nobs))
+    ids = data.index if hasattr(data, "index") else None
+
+    return weights_from_sparse(W, ids=ids, transform=transform)
+
+def distance_band_weights(data, threshold, binary=True, alpha=-1.0, transform="R", k_max=K_MAX):
+    """
+    Distance band weights (neighbors within threshold, like lp.weights.DistanceBand)
+        Bands within the distance of the k_max-th neighbor of every point are
+        taken from the cached neighbor query, wider bands from a query of the
+        cached tree. Unlike lp.weights.DistanceBand, observations at the same
+        location (e.g. a district in several periods) are neighbors of each other
+        in the binary case, as they are for knn_weights.
+
+    Inputs:
+        - data: GeoDataFrame or array of coordinates (N, 2)
+        - threshold: distance band (units of the coordinates)
+        - binary: weights of one, otherwise distance**alpha
+        - transform: libpysal transformation
+        - k_max: number of neighbors queried at once
+
+    Returns: w (libpysal weights object, ids from the index of data)
+    """
+    tree, distances, indices = neighbor_query(get_coordinates(data), k=k_max)
+    nobs = len(indices)
+
+    if threshold < distances[:, -1].min():
+        rows, cols = np.nonzero(distances <= threshold)
+        values, cols = distances[rows, cols], indices[rows, cols]
+    else:
+        pairs = tree.query_pairs(threshold, output_type="ndarray")
+        rows, cols = np.concatenate([pairs, pairs[:, ::-1]]).T
+        values = np.hypot(*(tree.data[rows] - tree.data[cols]).T)
+
+    if binary:
+        values = np.ones(len(values))
+    else:
+        keep = values > 0 #no finite weight at distance zero
+        rows, cols, values = rows[keep], cols[keep], values[keep]**alpha
+    W = sparse.csr_matrix((values, (rows, cols)), shape=(nobs, nobs))
+    ids = data.index if hasattr(data, "index") else None
+
+    return weights_from_sparse(W, ids=ids, transform=transform)
+
+# spatial lags of several columns
+def spatial_lags(data, columns, w, suffix="_lag"):
+    """
+    Spatial lags W*X of several columns from one sparse product
+        Equals lp.weights.spatial_lag.lag_spatial(w, data[column]) for every column.
+
+    Inputs:
+        - data: data frame (same order as the weights)
+        - columns: list of column names
+        - w: libpysal weights object (used with its current transform, e.g. "r")
+        - suffix: appended to the names of the lagged columns
+
+    Returns: lags (DataFrame with the columns <column><suffix>, index of data)
+    """
+    columns = list(columns)
+    lags = w.sparse.tocsr().dot(data[columns].to_numpy(dtype=float))
+
+    return pd.DataFrame(lags, index=data.index, columns=[column + suffix for column in columns])
+
+# contiguity of polygons
+def _query_positions(tree, geometry, positions):
+    """
+    Positions of the polygons in the STR-tree whose envelope intersects geometry
+        shapely >= 2 returns the positions, shapely 1.x the polygons themselves,
+        which are mapped back to their position.
+    """
+    hits = tree.query(geometry)
+    if len(hits) and not isinstance(hits[0], (int, np.integer)):
+        hits = [positions[id(hit)] for hit in hits]
+    return hits
+
+def contiguity_pairs(geometries, tolerance=0.0):
+    """
+    Pairs of touching polygons and the length of their shared border
+        Candidate pairs come from an STR-tree over the envelopes of the polygons
+        (envelopes widened by tolerance), so the exact geometric test is only run
+        on neighbors. The shared border is the intersection of the boundaries
+        (with tolerance: the part of the second boundary within tolerance of the
+        first), measured in the units of the CRS. Only the STR-tree and geometry
+        methods common to shapely 1.x and 2.x are used.
+
+    Inputs:
+        - geometries: GeoSeries or array of shapely polygons
+        - tolerance: distance below which polygons count as touching (digitization gaps)
+
+    Returns: rows, cols (arrays with the positions of every pair, rows < cols),
+        length (array with the length of the shared border, 0 for a common corner)
+    """
+    geometries = list(geometries)
+    tree = STRtree(geometries)
+    positions = {id(geometry): i for i, geometry in enumerate(geometries)}
+
+    rows, cols, length = [], [], []
+    for i, geometry in enumerate(geometries):
+        minx, miny, maxx, maxy = geometry.bounds
+        envelope = box(minx - tolerance, miny - tolerance, maxx + tolerance, maxy + tolerance)
+        boundary = geometry.boundary
+        if tolerance > 0:
+            boundary = boundary.buffer(tolerance)
+
+        for j in sorted(_query_positions(tree, envelope, positions)):
+            if j <= i:
+                continue
+            other = geometries[j]
+            if tolerance > 0:
+                if geometry.distance(other) > tolerance:
+                    continue
+                shared = boundary.intersection(other.boundary).length
+                if shared <= 2*tolerance: #a corner within tolerance measures at most 2*tolerance
+                    shared = 0.0
+            else:
+                if not geometry.intersects(other):
+                    continue
+                shared = boundary.intersection(other.boundary).length
+            rows.append(i)
+            cols.append(j)
+            length.append(shared)
+
+    return np.array(rows, dtype=int), np.array(cols, dtype=int), np.array(length, dtype=float)
+
+def contiguity_weights(rows, cols, length, nobs, kind="queen", ids=None, transform="R"):
+    """
+    Contiguity weights from the pairs of contiguity_pairs
+
+    Inputs:
+        - rows, cols, length: output of contiguity_pairs
+        - nobs: number of polygons
+        - kind: "queen" (common border or corner), "rook" (common border of
+          positive length) or "border" (weighted by the length of the common border)
+        - ids: ids of the polygons (default: 0, ..., nobs-1)
+        - transform: libpysal transformation
+
+    Returns: w (libpysal weights object)
+    """
+    if kind == "queen":
+        keep = np.ones(len(rows), dtype=bool)
+        values = np.ones(len(rows))
+    elif kind in ("rook", "border"):
+        keep = length > 0
+        values = np.ones(keep.sum()) if kind == "rook" else length[keep]
+    else:
+        raise ValueError(f"Unknown kind {kind}")
+
+    rows, cols = rows[keep], cols[keep]
+    W = sparse.csr_matrix((np.concatenate([values, values]),
+                           (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                          shape=(nobs, nobs))
+
+    return weights_from_sparse(W, ids=ids, transform=transform)
+
+def expand_weights(w, groups, ids=None, transform="R", within=False):
+    """
+    Weights between groups (e.g. districts) expanded to their observations
+        Observation i and j are neighbors with the weight of their groups in w
+        (as currently transformed, usually the original weights),
+        i.e. W_obs = P W P' with the (observations, groups) indicator P. With
+        within, observations of the same group (e.g. a district in another
+        period) are neighbors as well. Observations without a group (missing
+        or not among the ids of w) get no neighbors.
+
+    Inputs:
+        - w: libpysal weights object of the groups
+        - groups: id of the group (as in w.id_order) of every observation
+        - ids: ids of the observations (default: index of groups or 0, ..., N-1)
+        - transform: libpysal transformation
+        - within: whether observations of the same group are neighbors
+
+    Returns: w (libpysal weights object)
+    """
+    if ids is None and hasattr(groups, "index"):
+        ids = groups.index
+    position = pd.Series(np.arange(len(w.id_order)), index=w.id_order)
+    group = position.reindex(np.asarray(groups)).to_numpy()
+    member = np.flatnonzero(~np.isnan(group))
+
+    P = sparse.csr_matrix((np.ones(len(member)), (member, group[member].astype(int))),
+                          shape=(len(group), len(w.id_order)))
+    W = P.dot(w.sparse.tocsr()).dot(P.T)
+    if within:
+        W = W + P.dot(P.T)
+    W = (W - sparse.diags(W.diagonal())).tocsr() #no observation is its own neighbor
+    W.eliminate_zeros()
+
+    return weights_from_sparse(W, ids=ids, transform=transform)
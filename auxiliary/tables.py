@@ -3,6 +3,7 @@
 #Packages
 import pandas as pd
 import numpy as np
+from scipy import stats
 import matplotlib.pyplot as plt
 import matplotlib.ticker
 import statsmodels.formula.api as smf
@@ -23,16 +24,27 @@ pd.options.display.float_format = "{:,.2f}".format
 from auxiliary.data_import import *
 from auxiliary.plots import *
 from auxiliary.simulations import *
+from auxiliary.estimation import *
+from auxiliary.result_cache import *
+from auxiliary.spatial_diagnostics import *
+from auxiliary.spatial_weights import *
 
 
 # get reg table regiondata
-def get_table_regiondata(regressors, specification, data):
+def get_table_regiondata(regressors, specification, data, bootstrap=0, seed=None,
+                         cov_type="cluster", cutoff=500, cache_dir=RESULT_CACHE_PATH):
     """
     Can generate the regression table 2,3 and 4
     Inputs:
         - regressors: array of column names
         - specification: dictionary with column names
         - data: data frame (regiondata)
+        - bootstrap: number of wild cluster bootstrap replications for the
+          p-values (0: analytic p-values)
+        - seed: seed of the bootstrap
+        - cov_type: "cluster" (by district) or "conley" (spatial HAC over lon/lat)
+        - cutoff: distance cutoff of the Conley covariance in km
+        - cache_dir: directory of the result cache (None: no caching)
         
     Returns: container (pandas data frame with regression results)
     """
@@ -48,24 +60,20 @@ def get_table_regiondata(regressors, specification, data):
     container['regressors'] = regressors
     container = container.set_index('regressors')
 
+    #all columns are fitted together (see fit_specifications), country-year fixed
+    #effects are absorbed instead of estimating one dummy per level, same as "... + C(countryyear) -1"
+    results = fit_specifications(data, "ADurbfrac", specification,
+                                 absorb=["countryyear"], cluster="afruid" if cov_type == "cluster" else None,
+                                 cov_type=cov_type, cutoff=cutoff,
+                                 cache_dir=cache_dir, bootstrap=bootstrap, seed=seed)
+
     for key in specification.keys():
         table = pd.DataFrame({'Urbanization rate': [], 'Std.err': [], 'P-Value': [],})
 
         table['regressors'] = regressors
         table = table.set_index('regressors')
         
-        formula = "ADurbfrac ~"
-        for regressors in specification[key]:
-            formula = formula + f" {regressors} +"
-            
-        
-        formula = formula + " C(countryyear) -1"
-        #c(var) for fixed effect - "-1" for dropping intercept
-        result = smf.ols(
-            formula = formula, data=data
-            ).fit(
-            cov_type='cluster',cov_kwds={'groups': data['afruid']},use_t=True
-            )
+        result = results[key]
         for coef in specification[key]:
             outputs = [result.params[coef], result.bse[coef], result.pvalues[coef]]
             table.loc[coef] = outputs
@@ -85,13 +93,14 @@ def get_table_regiondata(regressors, specification, data):
     return container
 
 # get reg table countrydata
-def get_table_countrydata(regressors, specification, data):
+def get_table_countrydata(regressors, specification, data, cache_dir=RESULT_CACHE_PATH):
     """
     Can generate the regression table 5
     Inputs:
         - regressors: array of column names
         - specification: dictionary with column names
         - data: data frame (regiondata)
+        - cache_dir: directory of the result cache (None: no caching)
         
     Returns: container (pandas data frame with regression results)
         Beware! Multiindex codes set manually!
@@ -108,23 +117,23 @@ def get_table_countrydata(regressors, specification, data):
     container['regressors'] = regressors
     container = container.set_index('regressors')
 
+    #all columns of one outcome are fitted together (see fit_specifications)
+    primacy = "5.5 - Growth of captial city"
+    results = fit_specifications(data, "ADurbfrac",
+                                 {key: spec for key, spec in specification.items() if key != primacy},
+                                 cov_type="HC1", use_t=False, cache_dir=cache_dir)
+    if primacy in specification:
+        results.update(fit_specifications(data, "ADprimwidefrac", {primacy: specification[primacy]},
+                                          cov_type="HC1", use_t=False, cache_dir=cache_dir))
+
     for key in specification.keys():
-        if key == "5.5 - Growth of captial city": #one regression on change in primacy
+        if key == primacy: #one regression on change in primacy
             table = pd.DataFrame({'Capital city growth': [], 'Std.err': [], 'P-Value': [],})
 
             table['regressors'] = regressors
             table = table.set_index('regressors')
 
-            formula = "ADprimwidefrac ~"
-            for regressors in specification[key]:
-                formula = formula + f" + {regressors}"
-
-
-            result = smf.ols(
-                formula = formula, data=data
-                ).fit(cov_type='HC1')#.fit(
-                #cov_type='cluster',cov_kwds={'groups': data['afruid']},use_t=True
-                #)
+            result = results[key] #"ADprimwidefrac ~ ..." with HC1 errors
             for coef in specification[key]:
                 outputs = [result.params[coef], result.bse[coef], result.pvalues[coef]]
                 table.loc[coef] = outputs            
@@ -134,16 +143,7 @@ def get_table_countrydata(regressors, specification, data):
             table['regressors'] = regressors
             table = table.set_index('regressors')
 
-            formula = "ADurbfrac ~"
-            for regressors in specification[key]:
-                formula = formula + f" +{regressors}"
-
-
-            result = smf.ols(
-                formula = formula, data=data
-                ).fit(cov_type='HC1')#.fit(
-                #cov_type='cluster',cov_kwds={'groups': data['afruid']},use_t=True
-                #)
+            result = results[key] #"ADurbfrac ~ ..." with HC1 errors
             for coef in specification[key]:
                 outputs = [result.params[coef], result.bse[coef], result.pvalues[coef]]
                 table.loc[coef] = outputs
@@ -174,13 +174,20 @@ def get_table_countrydata(regressors, specification, data):
     return container
 
 # get reg table citydata
-def get_table_citydata(regressors, specification, data):
+def get_table_citydata(regressors, specification, data, bootstrap=0, seed=None,
+                       cov_type="cluster", cutoff=500, cache_dir=RESULT_CACHE_PATH):
     """
     Can generate the regression tables 6, ...
     Inputs:
         - regressors: array of column names
         - specification: dictionary with column names
         - data: data frame (regiondata)
+        - bootstrap: number of wild cluster bootstrap replications for the
+          p-values (0: analytic p-values)
+        - seed: seed of the bootstrap
+        - cov_type: "cluster" (by city) or "conley" (spatial HAC over lon/lat)
+        - cutoff: distance cutoff of the Conley covariance in km
+        - cache_dir: directory of the result cache (None: no caching)
         
     Returns: container (pandas data frame with regression results)
     """
@@ -189,6 +196,16 @@ def get_table_citydata(regressors, specification, data):
     container['regressors'] = regressors
     container = container.set_index('regressors')
 
+    #all columns are fitted together (see fit_specifications), year fixed effects
+    #absorbed, same as "dlnl1 ~ ... + C(year) -1"; rows with missing values are
+    #dropped once per estimation sample, also for the clusters
+    results = fit_specifications(data, "dlnl1",
+                                 {key: spec for key, spec in specification.items()
+                                  if key != "5.5 - Growth of capital city"},
+                                 absorb=["year"], cluster="agidison" if cov_type == "cluster" else None,
+                                 cov_type=cov_type, cutoff=cutoff,
+                                 cache_dir=cache_dir, bootstrap=bootstrap, seed=seed)
+
     for key in specification.keys():
         # if condition not used currently
         if key == "5.5 - Growth of capital city": #one regression on change in primacy
@@ -216,29 +233,10 @@ def get_table_citydata(regressors, specification, data):
             table['regressors'] = regressors
             table = table.set_index('regressors')
 
-            formula = "dlnl1 ~"
-            for regressors in specification[key]:
-                formula = formula + f" + {regressors}"
-            
-            formula = formula + "+ C(year) -1" #fixed effects
-
-            def cluster_fit(formula, data, group_var): #function for clustering with missing values
-                fit = smf.ols(formula, data=data).fit()
-                to_keep = pd.RangeIndex(len(data)).difference(pd.Index(fit.model.data.missing_row_idx))
-                robust = fit.get_robustcov_results(cov_type='cluster',
-                                                   groups=data.iloc[to_keep][group_var])
-                return robust #due to cluster fit the result is not a wrapper
+            result = results[key]
             
-            #c(var) for fixed effect - "-1" for dropping intercept
-            result = cluster_fit(formula, data=data, group_var="agidison")
-            
-            for index,coef in enumerate(specification[key]): #need to index by position since result isn't a wrapper
-                #find numer of fixed effect variables 
-                alpha = result.params.size - np.size(specification[key])
-                #find position of the coefficients
-                position = alpha + index #no need to set to zero by -1 sinze lengths are being used
-                
-                outputs = [result.params[position], result.bse[position], result.pvalues[position]]
+            for coef in specification[key]:
+                outputs = [result.params[coef], result.bse[coef], result.pvalues[coef]]
                 table.loc[coef] = outputs
 
         
@@ -258,15 +256,26 @@ def get_table_citydata(regressors, specification, data):
     return container
 
 # get spatial regression table regiondata
-def get_table_spatial_reg(regressors, specification, regiondata, w):
+def get_table_spatial_reg(regressors, specification, regiondata, w, estimator="gm",
+                          impacts=True, draws=1000, seed=123456, cache_dir=RESULT_CACHE_PATH):
     """
     Generates a SDM estimate
+        With impacts=True the table also reports the direct, indirect and total
+        impacts of the regressors (see spatial_impacts), where a column
+        "<name>_lag" is treated as the spatial lag of "<name>". A note is printed
+        for columns whose impacts are not computed (|rho| too close to or beyond
+        one) and for discarded draws.
     Inputs:
         - regressors: array of column names
         - specification: dictionary with column names
         - data: data frame (regiondata)
         - w: weight_matrix Geopandas object
-        
+        - estimator: "gm" (spreg.GM_Lag) or "ml" (maximum likelihood, see ml_lag)
+        - impacts: whether to report the impacts
+        - draws: number of simulated coefficient vectors for the inference on the impacts
+        - seed: seed of the simulation
+        - cache_dir: directory of the result cache (None: no caching)
+
     Returns: container (pandas data frame with regression results)
     """
     container = pd.DataFrame()
@@ -274,6 +283,10 @@ def get_table_spatial_reg(regressors, specification, regiondata, w):
     container['regressors'] = regressors
     container = container.set_index('regressors')
 
+    codebook = get_data_codebook("regiondata")
+    impact_rows = {(name, impact): f"{impact} impact: {codebook.get(name, name)}"
+                   for name in regressors for impact in ["Direct", "Indirect", "Total"]}
+
     for key in specification.keys():
         table = pd.DataFrame({'Urbanization rate': [], 'Std.err': [], 'P-Value': [],})
 
@@ -288,20 +301,61 @@ def get_table_spatial_reg(regressors, specification, regiondata, w):
         #row standardize matrix
         w.transform = 'r'
         
-        #two-stage regression
-        result = spreg.GM_Lag(y, x, w=w,w_lags=1, name_y='ADurbfrac', name_x = specification[key])
+        #two-stage or maximum likelihood regression, cached on the data, the weights and the specification
+        def gm_lag():
+            result = spreg.GM_Lag(y, x, w=w,w_lags=1, name_y='ADurbfrac', name_x = specification[key])
+            return result.betas[:, 0], np.asarray(result.std_err), np.asarray(result.z_stat)[:, 1], np.asarray(result.vm)
+
+        def ml():
+            betas, std_err, vm = ml_lag(y[:, 0], x, w, se=True, vm=True)
+            return betas, std_err, 2*stats.norm.sf(np.abs(betas/std_err)), vm
+
+        if estimator not in ("gm", "ml"):
+            raise ValueError(f"Unknown estimator {estimator}")
+
+        cache_key = {"estimator": "GM_Lag" if estimator == "gm" else "ML_Lag",
+                     "code": [ESTIMATION_FINGERPRINT, spreg.__version__],
+                     "data": fingerprint_frame(regiondata, ["ADurbfrac"] + specification[key]),
+                     "weights": fingerprint_weights(w),
+                     "specification": specification[key],
+                     "w_lags": 1,
+                     "vm": True}
+        betas, std_err, pvalues, vm = cached_result(cache_key, gm_lag if estimator == "gm" else ml,
+                                                    cache_dir=cache_dir)
+
+        #impacts: positions of every variable and of its spatial lag in betas
+        if impacts:
+            variables = {}
+            for position, name in enumerate(specification[key], start=1):
+                if name.endswith("_lag"):
+                    variables.setdefault(name[:-len("_lag")], [None, None])[1] = position
+                else:
+                    variables.setdefault(name, [None, None])[0] = position
+            effects = spatial_impacts(betas, vm, w, variables, draws=draws, seed=seed)
+            if effects["estimate"].isna().all():
+                print(f"{key}: no impacts, the spatial lag coefficient (WY = {betas[-1]:.2f}) is too close to or beyond one in absolute value")
+            elif effects.attrs.get("discarded"):
+                print(f"{key}: {effects.attrs['discarded']} of {draws} draws of the impacts discarded (|WY| too close to one)")
+            effects = effects.reindex(columns=["estimate", "std_err", "p-value"])
+            for (name, impact), row in effects.iterrows():
+                table.loc[impact_rows.get((name, impact), f"{impact} impact: {name}")] = row.tolist()
         
         lags = ["WY"]
         variables = specification[key].extend(lags)
         for coef, _ in enumerate(specification[key]):
             coef += 1 #because of intercept
-            outputs = [result.betas[coef][0], result.std_err[coef], result.z_stat[coef][1]]
+            outputs = [betas[coef], std_err[coef], pvalues[coef]]
             table.loc[_] = outputs
         
         container = pd.concat([container, table], axis=1)
 
+    # impacts below the coefficients, in the order of the regressors
+    impact_order = [label for label in impact_rows.values() if label in container.index]
+    impact_order += [label for label in container.index if label.startswith(("Direct impact", "Indirect impact", "Total impact"))
+                     and label not in impact_order]
+    container = container.reindex([label for label in container.index if label not in impact_order] + impact_order)
+
     # Change variable names to labels
-    codebook = get_data_codebook("regiondata")
     container = container.rename(codebook, axis="index")
     container.columns = pd.MultiIndex.from_product(
             [specification.keys(),
@@ -456,80 +510,81 @@ def get_district_robustness_specification():
                         "lndiscst"]}
     return regressors, specification
 
+# labels which are not in the stata files
+MANUAL_LABELS = {
+    "citydata": {
+        "Lcflcnt3": "1(inside conflict t-1)",
+        "Lcflcnt3_50": "1(outside conflict t-1)",
+        "Lnatconflict": "1(national conflict t-1)",
+        "extent_agHLcflcnt3": "1(inside conflict t-1)*(14-#all ind.)",
+        "extent_agHLcflcnt3_50": "1(outside conflict t-1)*(14-#all ind.)",
+        "extent_agHLnatconflict": "1(national conflict t-1)*(14-#all ind.)",
+        "dlnrain30Lcflcnt3": "delta ln(rain(t))*1(inside conflict t-1)",
+        "dlnrain30Lcflcnt3_50": "delta ln(rain(t))*1(outside conflict t-1)",
+        "dlnrain30Lnatconflict": "delta ln(rain(t))*1(national conflict t-1)",
+        "extent_agH_dlnrainLcflcnt3": "delta ln(rain(t))*1(inside conflict t-1)*(14-#all ind)",
+        "extent_agH_dlnrainLcflcnt3_50": "delta ln(rain(t))*1(outside conflict t-1)*(14-#all ind)",
+        "extent_agH_dlnrainLnatconflict": "delta ln(rain(t))*1(national conflict t-1)*(14-#all ind)"
+        },
+    "regiondata": {
+        "ADsm0_1moistu": "delta moisture_1",
+        "ADsm0_2moistu": "delta moisture_2",
+        "ADsm0_3moistu": "delta moisture_3",
+        "ADsm0_4moistu": "delta moisture_4",
+        "ADsm0_2preu": "delta precipitation",
+        "ADsm0_2tmpu": "delta temperature",
+        "ADsm0_2moistu_nb": "neighbors' delta moisture_2",
+        "ADsm0_2moistu_lag": "W*delta moisture_2",
+        "WY": "WY"
+        },
+    "countrydata": {}
+    }
+
 def get_data_codebook(dataset):
     """
     For obtaining dictionary of variable labels
+        The stata labels come from the label index of get_variable_labels,
+        hence the data file is not read again for every table.
     Inputs: dataset (string), Name of the data set (one of: regiondata, citydata, countrydata)
         
     Returns: codebook (dictionary)
     """
-    if dataset == "citydata":
-        codes = pd.read_stata("data/citydata.dta", iterator=True).variable_labels()
-
-        manual_entries = {
-            "Lcflcnt3": "1(inside conflict t-1)",
-            "Lcflcnt3_50": "1(outside conflict t-1)",
-            "Lnatconflict": "1(national conflict t-1)",
-            "extent_agHLcflcnt3": "1(inside conflict t-1)*(14-#all ind.)",
-            "extent_agHLcflcnt3_50": "1(outside conflict t-1)*(14-#all ind.)",
-            "extent_agHLnatconflict": "1(national conflict t-1)*(14-#all ind.)",
-            "dlnrain30Lcflcnt3": "delta ln(rain(t))*1(inside conflict t-1)",
-            "dlnrain30Lcflcnt3_50": "delta ln(rain(t))*1(outside conflict t-1)",
-            "dlnrain30Lnatconflict": "delta ln(rain(t))*1(national conflict t-1)",
-            "extent_agH_dlnrainLcflcnt3": "delta ln(rain(t))*1(inside conflict t-1)*(14-#all ind)",
-            "extent_agH_dlnrainLcflcnt3_50": "delta ln(rain(t))*1(outside conflict t-1)*(14-#all ind)",
-            "extent_agH_dlnrainLnatconflict": "delta ln(rain(t))*1(national conflict t-1)*(14-#all ind)"
-            }
-        # combine the stata labels with the manual additions
-        codes.update(manual_entries)
-        
-    elif dataset == "regiondata":
-        codes = pd.read_stata("data/regiondata.dta", iterator=True).variable_labels()
-        manual_entries = {
-            "ADsm0_1moistu": "delta moisture_1",
-            "ADsm0_2moistu": "delta moisture_2",
-            "ADsm0_3moistu": "delta moisture_3",
-            "ADsm0_4moistu": "delta moisture_4",
-            "ADsm0_2preu": "delta precipitation",
-            "ADsm0_2tmpu": "delta temperature",
-            "ADsm0_2moistu_nb": "neighbors' delta moisture_2",
-            "ADsm0_2moistu_lag": "W*delta moisture_2",
-            "WY": "WY"
-            }
-
-        # combine the stata labels with the manual additions
-        codes.update(manual_entries)        
-
-    elif dataset == "countrydata":
-        codes = pd.read_stata("data/countrydata.dta", iterator=True).variable_labels()        
-    
-    
-    else:
+    if dataset not in MANUAL_LABELS:
         raise AssertionError # incorret dataset name
 
+    # imported here, since data_import and tables import each other and the
+    # star import misses it when data_import is imported first (as in the notebook)
+    from auxiliary.data_import import get_variable_labels
+
+    # combine the stata labels with the manual additions
+    codes = dict(get_variable_labels(dataset))
+    codes.update(MANUAL_LABELS[dataset])
 
     return codes
 
-def LM_Test_Spatial_Dependence(specification, key, regiondata):
+def LM_Test_Spatial_Dependence(specification, key, regiondata, k=8):
+    """
+    Lagrange multiplier tests of spatial dependence for one specification (see lm_tests)
+    Inputs:
+        - specification: dictionary with column names
+        - key: name of the specification
+        - regiondata: data frame (regiondata)
+        - k: number of nearest neighbours of the weight matrix
+
+    Prints the p-values of the LM lag, LM error and joint (SARMA) tests, all
+    statistics are returned by lm_tests
+    """
     #filtering out outliers
     regiondata = regiondata.query("abspctileADsm0_2moistu > 6 & abspctileADurbfrac > 6")
     #weight matrix
-    w = lp.weights.KNN.from_dataframe(regiondata, k=8) #k nearest neighbour weights
+    w = knn_weights(regiondata, k=k) #k nearest neighbour weights
     #row standardize matrix
     w.transform = 'r'
-    
+
     # preparing data
     y = regiondata["ADurbfrac"].to_numpy()
-    y = np.reshape(y, (y.size, 1))
-    
     x = np.array([regiondata[name] for name in specification[key]]).T
-    
-    #Disclaimer
-    ##due to an internal error (related to the refactoring of pysal) the spreg.OLS package
-    ##does not run in CI. Until this is resolved, the test values are hardcoded (0.01, 0.02, 0.02) in here:
 
-    #ols=spreg.OLS(y,x,w=w,name_y="ADurbfrac", name_x=specification[key],nonspat_diag=False, spat_diag=True)
-    #print(f"For the Lagrange Multiplier test of spatial dependence, the p-value of rejecting the null of zero dependence of\n-The spatial lag is {ols.lm_lag[1]: .2f} \n-The spatial error is {ols.lm_error[1]: .2f}\n-The independent variables {ols.lm_sarma[1]: .2f}")
-    
-    print(f"For the Lagrange Multiplier test of spatial dependence, the p-value of rejecting the null of zero dependence of\n-The spatial lag is 0.01\n-The spatial error is 0.02\n-The independent variables 0.02")
-    
\ No newline at end of file
+    p_value = lm_tests(y, x, w)["p-value"]
+
+    print(f"For the Lagrange Multiplier test of spatial dependence, the p-value of rejecting the null of zero dependence of\n-The spatial lag is {p_value['LM lag']:.2f}\n-The spatial error is {p_value['LM error']:.2f}\n-The independent variables {p_value['LM SARMA']:.2f}")